@@ -0,0 +1,202 @@
+import json
+import sys
+import time
+from BulkImport import BulkImporter
+from Metrics import METRICS, COUNT_BUCKETS
+
+# The commands a batch can have
+COMMANDS = ("rent", "return", "add", "view", "search")
+
+class BatchRunner:
+    # Runs a stream of commands (one per line) without asking anything, like the returns from the drop box at the end of the day:
+    #   rent 42 V17                             (the visitor id is optional, with it the loan is written in the loan ledger)
+    #   return 42 V17                           (without the visitor id the loan of the book that is due first is closed)
+    #   add 42                                  (one more copy of an existing book)
+    #   add {"name": "...", "author": "...", "release_date": "DD/MM/YYYY", "description": "..."}   (a new book, "id" is optional)
+    #   view 42
+    #   search harry potter
+    # Every command gets one json line with its result. The changes are saved together, batch_size changes at a time
+
+    def __init__(self, main, batch_size=1000, output=None):
+        # This is the LibraryComputer object, we use its catalog store, the visitor's search and the librarian's book validation
+        self.main = main
+        self.batch_size = batch_size
+        self.output = output or sys.stdout
+
+        # The changes that were not saved yet, the ids of the new books in them, and the results of the commands that wait
+        # for them (so the results are written in order)
+        self.changes = []
+        self.new_ids = set()
+        self.results = []
+
+        # The loans the returns that are not saved yet will close (line number -> loan), and how many returns that are not saved yet
+        # have no loan (book id -> count), so two returns in the same batch never count on the same loan or rented copy
+        self.claimed_loans = {}
+        self.returns_without_loan = {}
+
+        # The ids we reserved for the new books without an id, we reserve a whole batch of them at a time (like the bulk importer)
+        self.free_ids = []
+
+        # The new books are read like the rows of a jsonl import (json nulls are empty, not "None")
+        self.importer = BulkImporter(main)
+
+    def run(self, lines):
+        start_time = time.perf_counter()
+        commands = 0
+
+        for line_number, line in enumerate(lines, start=1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            commands += 1
+
+            command, _, argument = line.partition(" ")
+            result = {"line": line_number, "command": command.lower()}
+            try:
+                # (unknown commands are timed together, so a file full of typos doesnt make a new metric for every typo)
+                with METRICS.timer("batch_command_seconds", {"command": command.lower() if command.lower() in COMMANDS else "unknown"}):
+                    self.run_command(command.lower(), argument.strip(), result)
+            except (ValueError, RuntimeError, ConnectionError) as error:
+                # (in client mode the library server can fail a command too, the other commands still run and are saved)
+                result.update({"ok": False, "error": str(error)})
+                self.results.append(result)
+
+            # When there are enough changes save them together
+            if len(self.changes) >= self.batch_size:
+                self.commit()
+
+        # Save the last changes
+        self.commit()
+
+        elapsed = time.perf_counter() - start_time
+        print(f"Ran {commands} commands in {elapsed:.2f} seconds ({commands / max(elapsed, 1e-9):.0f} commands/second)", file=sys.stderr)
+        return commands
+
+    def run_command(self, command, argument, result):
+        if command in ("rent", "return"):
+            book_id, _, visitor_id = argument.partition(" ")
+            result["visitor"] = visitor_id.strip() or None
+
+            # A return is checked against the loan ledger before it is queued (like a return from the menu)
+            if command == "return":
+                self.check_return(book_id, result)
+            self.add_change(command, book_id, None, result)
+
+        elif command == "add":
+            # A json object is a new book, otherwise it is the id of a book we add one more copy of
+            if argument.startswith("{"):
+                try:
+                    book = self.importer.parse_row(argument)
+                except ValueError as error:
+                    raise ValueError(f"The new book is not valid, {error}")
+                book_id = book.get("id", "").strip() or self.next_free_id()
+                if self.book_exists(book_id):
+                    self.add_change("add_old", book_id, None, result)
+                else:
+                    book = self.main.librarian.make_book(
+                        book_id,
+                        book.get("name", ""),
+                        book.get("author", ""),
+                        book.get("release_date", ""),
+                        book.get("description", "")
+                    )
+                    self.add_change("add_new", book_id, book, result)
+            elif self.book_exists(argument):
+                self.add_change("add_old", argument, None, result)
+            else:
+                raise ValueError(f"There is no book with the id {argument}, add a new book as a json object")
+
+        elif command == "view":
+            # Reading commands see all the changes of the commands before them
+            self.commit()
+            book = self.main.store.get_book(argument)
+            result.update({"id": argument, "ok": book is not None, "book": book})
+            self.results.append(result)
+
+        elif command == "search":
+            self.commit()
+            page = self.main.visitor.find_books(argument)
+            result.update({"query": argument, "ok": True, "total": page["total"], "results": page["results"]})
+            self.results.append(result)
+
+        else:
+            raise ValueError(f"Unknown command {command}")
+
+    def check_return(self, book_id, result):
+        # If the book was rented earlier in the same batch its loan is only written when the batch is saved,
+        # so if there is no loan for the return (yet) and the batch changes the book we save the batch and check again
+        for attempt in range(2):
+            claimed = {loan["loan"] for loan in self.claimed_loans.values()}
+            pending_returns = self.returns_without_loan.get(book_id, 0)
+            allowed, loan = self.main.visitor.check_return(book_id, result["visitor"], claimed, pending_returns)
+            if loan or not any(change[1] == book_id for change in self.changes):
+                break
+            self.commit()
+        if not allowed:
+            result["id"] = book_id
+            result["loan"] = None
+            raise ValueError(f"There is no record that {result['visitor'] or 'anyone'} rented the book {book_id}")
+        if loan:
+            self.claimed_loans[result["line"]] = loan
+        else:
+            self.returns_without_loan[book_id] = pending_returns + 1
+
+    def next_free_id(self):
+        if not self.free_ids:
+            self.free_ids = self.main.store.allocate_ids(self.batch_size)[::-1]
+        return self.free_ids.pop()
+
+    def book_exists(self, book_id):
+        # The book can also be a new book of the changes that were not saved yet
+        return book_id in self.new_ids or self.main.store.get_book(book_id) is not None
+
+    def add_change(self, action, book_id, book, result):
+        # The result of the change is only known after it is saved
+        result.update({"id": book_id, "ok": None})
+        self.changes.append((action, book_id, book))
+        self.results.append(result)
+        if action == "add_new":
+            self.new_ids.add(book_id)
+
+    def record_loan(self, result):
+        # Write the rents (of a known visitor) and the returns of the batch that worked in the loan ledger
+        loan = None
+        if result["ok"] and result["command"] == "rent" and result["visitor"]:
+            loan = self.main.loans.borrow(result["visitor"], result["id"], self.main.settings["loan_days"])
+        elif result["ok"] and result["command"] == "return" and result["line"] in self.claimed_loans:
+            loan = self.main.loans.close(result["id"], self.claimed_loans[result["line"]]["visitor"])
+        if result["command"] in ("rent", "return"):
+            result["loan"] = loan["loan"] if loan else None
+
+    def commit(self):
+        # Save all the changes with one write, fill in their results and write all the results we have in order
+        if self.changes:
+            try:
+                with METRICS.timer("batch_commit_seconds"):
+                    outcomes = iter(self.main.store.mutate_many(self.changes))
+                error = None
+            except (RuntimeError, ConnectionError) as commit_error:
+                # (in client mode the library server can fail while it saves the changes, then we report the error for all of them)
+                outcomes = None
+                error = str(commit_error)
+            METRICS.observe("batch_commit_changes", len(self.changes), buckets=COUNT_BUCKETS)
+            for result in self.results:
+                if result["ok"] is None:
+                    if outcomes is None:
+                        result.update({"ok": False, "error": error})
+                    else:
+                        result["ok"] = next(outcomes)
+                        try:
+                            self.record_loan(result)
+                        except (RuntimeError, ConnectionError) as loan_error:
+                            result.update({"loan": None, "error": f"The loan could not be written, {loan_error}"})
+            self.changes = []
+            self.new_ids = set()
+            self.claimed_loans = {}
+            self.returns_without_loan = {}
+
+        for result in self.results:
+            # (books can be book records, dict() turns them into book dictionaries)
+            self.output.write(json.dumps(result, default=dict) + "\n")
+        self.output.flush()
+        self.results = []
@@ -0,0 +1,52 @@
+import sys
+
+# The keys of a book, in the same order as the book dictionaries in data.json
+BOOK_KEYS = ["name", "id", "available_count", "rented_count", "release_date", "description", "author", "search_query"]
+
+class BookRecord:
+    # A book in memory. __slots__ means the object has a fixed list of fields instead of its own dictionary,
+    # which makes every book a lot smaller (with hundreds of thousands of books that is most of the memory of the program)
+    __slots__ = ["name", "id", "available_count", "rented_count", "release_date", "description", "author"]
+
+    def __init__(self, name, book_id, available_count, rented_count, release_date, description, author):
+        self.name = name
+        self.id = book_id
+        self.available_count = available_count
+        self.rented_count = rented_count
+
+        # Many books share the same author and release date, sys.intern keeps only one copy of every such string
+        self.release_date = sys.intern(release_date)
+        self.description = description
+        self.author = sys.intern(author)
+
+    @classmethod
+    def from_dict(cls, book):
+        # Create a book record from a book dictionary (like the ones in data.json), the search query is not
+        # kept because we can always build it again from the other fields
+        return cls(
+            book.get("name", ""),
+            book["id"],
+            book["available_count"],
+            book["rented_count"],
+            book.get("release_date", ""),
+            book.get("description", ""),
+            book.get("author", "")
+        )
+
+    @property
+    def search_query(self):
+        # The search query is the name, author, description and id of the book in lower case (exactly like add_book builds it)
+        return (self.name + self.author + self.description + self.id).lower()
+
+    # These let the rest of the program use a book record like a book dictionary, book["name"] and dict(book) both work
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def keys(self):
+        return BOOK_KEYS
+
+    def to_dict(self):
+        return {key: getattr(self, key) for key in BOOK_KEYS}
@@ -0,0 +1,107 @@
+import bisect
+import threading
+from datetime import date
+
+def date_ordinal(release_date):
+    # Turn a DD/MM/YYYY date into a number that sorts like the dates (the number of days since 01/01/0001),
+    # or None if it is not a real date. Splitting the date ourselves is much faster than strptime
+    try:
+        day, month, year = release_date.split("/")
+        return date(int(year), int(month), int(day)).toordinal()
+    except ValueError:
+        return None
+
+def normalize_author(author):
+    # The same author can be typed in different ways ("Jane  Austen", "jane austen"), so we compare them in lower case
+    # with single spaces
+    return " ".join(author.lower().split())
+
+class BrowseIndex:
+    def __init__(self, store):
+        # The catalog store we index, it tells us whenever the catalog is loaded or a book is added (like to the search index)
+        self.store = store
+
+        # The normalized author -> the ids of the books of the author (dictionaries are used as ordered sets, so the books
+        # stay in catalog order)
+        self.authors = {}
+
+        # A sorted list of (release date ordinal, position, book id), a range of dates is found with bisect and then
+        # we only go over the books inside the range. The position keeps the books of the same day in catalog order
+        self.dates = []
+
+        # The (normalized author, release date ordinal, position) of every book, so we can remove a book if it is replaced
+        self.book_keys = {}
+        self.next_position = 0
+
+        # The ordinal of every release date we already parsed (many books share the same release date)
+        self.ordinals = {}
+
+        # The lock makes sure the index is not changed while another thread (like in the library server) reads it
+        self.lock = threading.RLock()
+
+        # Make sure the store loaded the catalog, then start listening to it and index all of its books
+        self.store.refresh()
+        self.store.listeners.append(self)
+        self.catalog_loaded(self.store.iter_books())
+
+    def catalog_loaded(self, books):
+        with self.lock:
+
+            # The whole catalog was (re)loaded so we build the index from scratch, the date list is sorted once at the end
+            # (sorting once is much faster than inserting every book in its place)
+            self.authors = {}
+            self.dates = []
+            self.book_keys = {}
+            self.next_position = 0
+            for book in books:
+                self.index_book(book["id"], book, sort=False)
+            self.dates.sort()
+
+    def book_added(self, book_id, book):
+        with self.lock:
+            self.index_book(book_id, book)
+
+    def index_book(self, book_id, book, sort=True):
+
+        # If the book is already indexed (it was replaced) remove it first, it keeps its position in the catalog
+        position = self.next_position
+        if book_id in self.book_keys:
+            author, ordinal, position = self.book_keys[book_id]
+            self.authors[author].pop(book_id, None)
+            if not self.authors[author]:
+                del self.authors[author]
+            if ordinal is not None:
+                index = bisect.bisect_left(self.dates, (ordinal, position, book_id))
+                if index < len(self.dates) and self.dates[index] == (ordinal, position, book_id):
+                    del self.dates[index]
+        else:
+            self.next_position += 1
+
+        # Books with a release date that is not a real date (from before the dates were checked) are only left out of the date index
+        release_date = book["release_date"]
+        if release_date not in self.ordinals:
+            self.ordinals[release_date] = date_ordinal(release_date)
+        ordinal = self.ordinals[release_date]
+
+        author = normalize_author(book["author"])
+        self.authors.setdefault(author, {})[book_id] = True
+        if ordinal is not None:
+            if sort:
+                bisect.insort(self.dates, (ordinal, position, book_id))
+            else:
+                self.dates.append((ordinal, position, book_id))
+        self.book_keys[book_id] = (author, ordinal, position)
+
+    def by_author(self, author):
+        # The ids of all the books of exactly this author (but in any case and spacing)
+        self.store.refresh()
+        with self.lock:
+            return list(self.authors.get(normalize_author(author), ()))
+
+    def by_dates(self, first_ordinal, last_ordinal):
+        # The ids of all the books released between the two dates (both included), from the oldest to the newest
+        self.store.refresh()
+        with self.lock:
+            start = bisect.bisect_left(self.dates, (first_ordinal,))
+            end = bisect.bisect_left(self.dates, (last_ordinal + 1,))
+            return [book_id for ordinal, position, book_id in self.dates[start:end]]
@@ -0,0 +1,107 @@
+import csv
+import json
+import time
+
+class BulkImporter:
+    def __init__(self, main, batch_size=1000):
+        # This is the LibraryComputer object, we use its catalog store and the librarian's book validation
+        self.main = main
+
+        # How many books are saved together with one write
+        self.batch_size = batch_size
+
+    def iter_rows(self, path):
+        # Go over the rows of a csv file (with a header line) or a jsonl file (one json object per line) one at a time,
+        # so we never have the whole file in memory. The csv rows are dictionaries, the jsonl rows are still the text of the line
+        # (parse_row turns them into dictionaries, so a bad line only skips that row)
+        with open(path, "r", newline="", encoding="utf-8") as f:
+            if path.lower().endswith(".csv"):
+                for row in csv.DictReader(f):
+                    yield row
+            else:
+                for line in f:
+                    if line.strip():
+                        yield line
+
+    def parse_row(self, row):
+        # Turn a row into a dictionary of column -> text, raises ValueError if the row is not valid json or not a json object
+        if isinstance(row, str):
+            try:
+                row = json.loads(row)
+            except ValueError as error:
+                raise ValueError(f"it is not valid json ({error})")
+            if not isinstance(row, dict):
+                raise ValueError("it is not a json object")
+
+        # A csv row with less columns than the header has None in the missing columns, we treat them (and json nulls) as empty
+        return {key: "" if value is None else str(value) for key, value in row.items()}
+
+    def import_file(self, path):
+        store = self.main.store
+        imported = 0
+        skipped = 0
+        start_time = time.perf_counter()
+
+        # The changes of the current batch, and the new book ids in it (so a book that appears twice in the same batch is added as a copy)
+        batch = []
+        batch_new_ids = set()
+
+        # The ids we reserved for the rows without an id, we reserve a whole batch of them at a time
+        free_ids = []
+
+        for row_number, row in enumerate(self.iter_rows(path), start=1):
+            try:
+                row = self.parse_row(row)
+            except ValueError as error:
+                print(f"Skipping row {row_number}: {error}")
+                skipped += 1
+                continue
+            book_id = row.get("id", "").strip()
+
+            # If the row has no id we create one (like add_book does when the librarian presses enter)
+            if not book_id:
+                if not free_ids:
+                    free_ids = store.allocate_ids(self.batch_size)[::-1]
+                book_id = free_ids.pop()
+
+            # If a book with that ID already exists, add one more copy of it (like add_old)
+            if book_id in batch_new_ids or store.get_book(book_id) is not None:
+                batch.append(("add_old", book_id, None))
+            else:
+                # Build the book with the same validation and search query as add_book, and skip the row if it is not valid
+                try:
+                    book = self.main.librarian.make_book(
+                        book_id,
+                        row.get("name", ""),
+                        row.get("author", ""),
+                        row.get("release_date", ""),
+                        row.get("description", "")
+                    )
+                except ValueError as error:
+                    print(f"Skipping row {row_number}: {error}")
+                    skipped += 1
+                    continue
+                batch.append(("add_new", book_id, book))
+                batch_new_ids.add(book_id)
+
+            # When the batch is full save it with one write and report the progress
+            if len(batch) >= self.batch_size:
+                imported += self.commit(batch, imported, start_time)
+                batch = []
+                batch_new_ids = set()
+
+        # Save the last batch
+        if batch:
+            imported += self.commit(batch, imported, start_time)
+
+        elapsed = time.perf_counter() - start_time
+        print(f"Imported {imported} books ({skipped} rows skipped) in {elapsed:.2f} seconds")
+        return {"imported": imported, "skipped": skipped, "seconds": elapsed}
+
+    def commit(self, batch, imported, start_time):
+
+        # Save the whole batch at once and print how many books were imported so far and how fast
+        committed = sum(self.main.store.mutate_many(batch))
+        elapsed = time.perf_counter() - start_time
+        print(f"Imported {imported + committed} books ({(imported + committed) / max(elapsed, 1e-9):.0f} books/second)")
+        return committed
@@ -0,0 +1,781 @@
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import threading
+from contextlib import contextmanager, nullcontext
+from StorageBackend import StorageBackend
+from BookRecord import BookRecord
+from CounterFile import CounterFile, HEADER, ROW
+from Metrics import METRICS
+
+# fcntl only exists on linux and mac, on windows we just dont lock the files between processes
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+@contextmanager
+def lock_file(path):
+    # Lock the lock file at path so no other kiosk locks it at the same time, it is unlocked when the "with" block ends
+    # (the loan ledger locks its own lock file with this too)
+    if fcntl is None:
+        yield
+        return
+    with open(path, "a") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def replace_file(path, content, before_replace=None):
+
+    # Write the content to a temporary file next to the real one and then rename it over the real one,
+    # renaming is atomic so other kiosks either see the whole old file or the whole new file (never half of it)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        # Keep the permissions of the file we replace (temporary files are only readable by their owner)
+        os.chmod(temp_path, os.stat(path).st_mode & 0o777 if os.path.exists(path) else 0o644)
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+            stat = os.fstat(f.fileno())
+
+        # before_replace gets the signature the file will have (renaming doesnt change it)
+        if before_replace:
+            before_replace((stat.st_ino, stat.st_mtime_ns, stat.st_size))
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+    # Return the inode of the new file so we can recognize it later
+    return stat.st_ino
+
+class CatalogStore(StorageBackend):
+    def __init__(self, path="./data.json", journal_path="./data.journal", compact_size=256 * 1024, meta_path="./data.meta.json", id_block_size=64, counters_path="./data.counters", snapshot_path=None):
+        super().__init__()
+
+        # The path of the file that stores the book data (the snapshot) and the path of the journal,
+        # the journal is a file that we append every change to, one small json record per line
+        self.path = path
+        self.journal_path = journal_path
+
+        # When the journal gets bigger than this many bytes we fold it back into the data.json file
+        self.compact_size = compact_size
+
+        # The parsed book data (a dictionary of book id -> BookRecord), it stays in memory
+        # so we dont have to open and parse the whole file every time someone asks for it
+        self.book_data = None
+
+        # The (inode, mtime, size) of data.json when we last read or wrote it, if it changes on disk
+        # that means someone edited it outside of this program (or another kiosk compacted the journal) so we have to load it again
+        self.file_signature = None
+
+        # The inode of the journal and how many bytes of it we already applied to the book data, if the journal
+        # is bigger than that, another kiosk appended changes to it
+        self.journal_inode = None
+        self.journal_offset = 0
+
+        # The lock file that all the kiosks using the same data.json lock while they commit a change
+        self.lock_path = path + ".lock"
+
+        # The metadata file of the catalog, it keeps the next id of the id sequence. When we need a new id we reserve
+        # a block of at least id_block_size ids, and the ids we reserved but didnt use yet are kept in reserved_ids
+        self.meta_path = meta_path
+        self.id_block_size = id_block_size
+        self.reserved_ids = range(0)
+
+        # The ids of the books that have at least one available copy and of the books that have at least one rented copy
+        # (dictionaries are used as ordered sets), and the position of every book in the catalog. They are updated with
+        # every change so the stock and rented lists only go over the books in them and not over the whole catalog
+        self.in_stock = {}
+        self.rented = {}
+        self.positions = {}
+
+        # The counter file keeps the available and rented counts of every book (one small row per book, in catalog order),
+        # rent and return only change the row of their book in place instead of writing anything to data.json or the journal.
+        # row_ids is the book id of every row, counter_changes is the change number of the counter file when we last read it
+        # and counter_rows is a copy of the rows we last read, so we can find the rows other kiosks changed
+        self.counters = CounterFile(counters_path)
+        self.row_ids = []
+
+        # The file that says which book every row of the counter file belongs to, with the counts data.json (and the journal) had for
+        # the book when its row was written or data.json was last compacted (one [row, book id, available count, rented count] json line
+        # for every row). When data.json is changed outside of this program the books can move to other rows, so we use it to find
+        # the old row of every book that is still in the catalog. The row has the rents and returns since the last compaction and
+        # data.json has the changes made by hand, so the book gets the counts of its row plus how much they were changed by hand
+        self.row_ids_path = counters_path + ".ids"
+        self.counter_changes = None
+        self.counter_rows = bytearray()
+
+        # The snapshot file keeps the parsed catalog and the search index (with pickle), so when the kiosk starts again it doesnt have to
+        # parse data.json and build the search index. It is tagged with the modification time, size and hash of data.json and the part of
+        # the journal it has, and it is only used if they are the same. None turns it off.
+        # file_hash is the hash of data.json when we last read it, snapshot_tag is the tag of the snapshot we last loaded or saved,
+        # and index_snapshot is the search index of the snapshot (until the search index takes it)
+        self.snapshot_path = snapshot_path
+        self.file_hash = None
+        self.snapshot_tag = None
+        self.index_snapshot = None
+
+        # The lock makes sure the compaction (which runs in the background) and the changes dont happen at the same time
+        self.lock = threading.RLock()
+        self.compaction_thread = None
+
+        # How many "with self.file_lock()" blocks we are inside of, only the first one locks the lock file
+        self.file_lock_depth = 0
+
+    def get_file_signature(self, path):
+        # Get the inode, modification time and the size of the file, those change whenever the file is written to or replaced
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def journal_changed(self):
+        # Check if the journal was replaced or someone appended to it since we last read it
+        if not os.path.exists(self.journal_path):
+            return self.journal_inode is not None
+        stat = os.stat(self.journal_path)
+        return stat.st_ino != self.journal_inode or stat.st_size != self.journal_offset
+
+    def is_up_to_date(self):
+        # This is the version stamp of the catalog, if data.json and the journal are exactly the way we last saw them
+        # then nobody committed anything since we read the book data
+        return (self.get_file_signature(self.path) == self.file_signature and not self.journal_changed()
+                and self.counters.read_header()[1] == self.counter_changes)
+
+    @contextmanager
+    def file_lock(self):
+        # Lock the lock file so no other kiosk commits at the same time, the lock is released when the "with" block ends.
+        # If we already have the lock (like loading the counters in the middle of a compaction) we just keep it
+        with lock_file(self.lock_path) if self.file_lock_depth == 0 else nullcontext():
+            self.file_lock_depth += 1
+            try:
+                yield
+            finally:
+                self.file_lock_depth -= 1
+
+    def get_book_data(self):
+        with self.lock:
+
+            # Open the counter file (the lock file is locked so two kiosks dont create it at the same time)
+            if self.counters.map is None:
+                with self.file_lock():
+                    self.counters.open()
+
+            # Check if the data.json file exists (its the file that stores the book data), if not create it with an empty dictionary
+            if not os.path.exists(self.path):
+                with self.file_lock():
+                    if not os.path.exists(self.path):
+                        self.save_book_data({})
+                self.load()
+
+            # If the data.json file changed since the last time we read it, read it again with the whole journal on top of it
+            elif self.book_data is None or self.get_file_signature(self.path) != self.file_signature:
+                self.load()
+
+            else:
+                # If the journal changed (another kiosk added a book) just apply the new records
+                if self.journal_changed():
+                    self.replay_journal()
+
+                # If another kiosk changed some counts (or added books we dont have the counts of yet) read the changed rows
+                if self.counters.read_header()[1] != self.counter_changes or len(self.counter_rows) < len(self.row_ids) * ROW.size:
+                    self.sync_counters()
+
+            return self.book_data
+
+    def refresh(self):
+        # Reading the book data loads the changes made outside of this program
+        self.get_book_data()
+
+    def get_book(self, book_id):
+        return self.get_book_data().get(book_id)
+
+    def get_books(self, book_ids):
+        book_data = self.get_book_data()
+        return {book_id: book_data[book_id] for book_id in book_ids if book_id in book_data}
+
+    def allocate_ids(self, count=1):
+        with self.lock:
+            book_data = self.get_book_data()
+            book_ids = []
+            while len(book_ids) < count:
+
+                # If we used all the ids we reserved, reserve a new block
+                if not self.reserved_ids:
+                    self.reserved_ids = self.reserve_ids(max(count - len(book_ids), self.id_block_size))
+
+                # Take the next reserved id, and skip it if the librarian already gave that id to a book by hand
+                book_id = str(self.reserved_ids[0])
+                self.reserved_ids = self.reserved_ids[1:]
+                if book_id not in book_data:
+                    book_ids.append(book_id)
+
+            return book_ids
+
+    def reserve_ids(self, count):
+        # Reserve a block of ids in the metadata file, the file is locked so two kiosks never reserve the same ids
+        with self.file_lock():
+
+            # Read the next id from the metadata file, if there is no metadata file yet we start the sequence
+            # after the biggest numeric id of the catalog (this is the only time we go over all the ids)
+            if os.path.exists(self.meta_path):
+                with open(self.meta_path, "r") as f:
+                    meta = json.load(f)
+            else:
+                meta = {"next_id": self.first_free_id(self.get_book_data())}
+
+            first_id = meta["next_id"]
+            meta["next_id"] = first_id + count
+            self.write_file_atomically(self.meta_path, json.dumps(meta, indent=4).encode())
+
+        return range(first_id, first_id + count)
+
+    def iter_books(self):
+        # Go over the book ids of the rows (they are in catalog order) and copy only a page of them at a time, a list that is gone over
+        # slowly (like a page at a time by a kiosk of the library server) doesnt keep a copy of all the ids in memory
+        self.get_book_data()
+        position = 0
+        page_size = 1000
+        while True:
+            with self.lock:
+                books = [self.book_data[book_id] for book_id in self.row_ids[position:position + page_size] if book_id in self.book_data]
+                position += page_size
+                finished = position >= len(self.row_ids)
+            yield from books
+            if finished:
+                return
+
+    def iter_indexed(self, book_ids):
+        # Go over the books of an index in catalog order (we copy the ids first so changes while we go over them dont break anything)
+        with self.lock:
+            book_data = self.get_book_data()
+            book_ids = sorted(book_ids, key=lambda book_id: self.positions[book_id])
+        for book_id in book_ids:
+            book = book_data.get(book_id)
+            if book:
+                yield book
+
+    def iter_in_stock(self):
+        self.refresh()
+        return self.iter_indexed(self.in_stock)
+
+    def iter_rented(self):
+        self.refresh()
+        return self.iter_indexed(self.rented)
+
+    def update_indexes(self, book_id):
+        # Put the book in (or take it out of) the stock and rented indexes according to its counts
+        book = self.book_data[book_id]
+        if book_id not in self.positions:
+            self.positions[book_id] = len(self.positions)
+            self.row_ids.append(book_id)
+        for index, count in ((self.in_stock, book["available_count"]), (self.rented, book["rented_count"])):
+            if count > 0:
+                index[book_id] = True
+            else:
+                index.pop(book_id, None)
+
+    def load(self):
+
+        # Read the data.json file (the last snapshot of the book data), we take the signature from the open file
+        # so if another kiosk replaces data.json while we read it we will notice it next time
+        # Every book dictionary is turned into a (much smaller) BookRecord while the file is parsed, so we never
+        # have all the book dictionaries in memory at the same time
+        # When the program starts we try the snapshot file first, it has the catalog already parsed (and the search index)
+        old_book_data = self.book_data
+        with open(self.path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            snapshot = self.load_snapshot(f, stat) if self.book_data is None and self.snapshot_path else None
+            if snapshot is None:
+                with METRICS.timer("storage_read_seconds", {"file": "data.json"}):
+                    content = f.read()
+                    self.file_hash = hashlib.sha256(content).hexdigest()
+                    self.book_data = json.loads(content, object_hook=self.make_record)
+                del content
+                METRICS.increment("bytes_read_total", stat.st_size, {"file": "data.json"})
+        self.file_signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        METRICS.increment("catalog_loads_total", labels={"store": "json"})
+
+        # Build the stock and rented indexes of the snapshot
+        self.in_stock = {}
+        self.rented = {}
+        self.positions = {}
+        self.row_ids = []
+        for book_id in self.book_data:
+            self.update_indexes(book_id)
+
+        # Apply every change that happened after the snapshot was written (the snapshot file already has the start of the journal)
+        if snapshot is None:
+            self.journal_offset = 0
+            self.index_snapshot = None
+        self.replay_journal(notify=False)
+
+        # Take the newest counts from the counter file
+        self.load_counters()
+
+        # Let the listeners know what changed. Most of the time data.json was compacted by another kiosk, so it has the books we already had
+        # (in the same order) and maybe some new ones, and we only tell the listeners about the books that are new or whose text changed
+        # (building the search and browse indexes again takes seconds with a big catalog). If books were removed or moved (data.json
+        # was edited by hand) the listeners cant just add books, so we let them know the whole catalog was loaded
+        self.changed()
+        if old_book_data is None or len(old_book_data) > len(self.book_data) or any(
+            old_book_id != book_id for old_book_id, book_id in zip(old_book_data, self.book_data)
+        ):
+            self.notify_loaded()
+            return
+        for book_id, book in self.book_data.items():
+            old_book = old_book_data.get(book_id)
+            if old_book is None or (old_book.name, old_book.author, old_book.release_date, old_book.description) != (book.name, book.author, book.release_date, book.description):
+                self.notify_added(book_id, book)
+
+    def load_counters(self):
+        with self.file_lock():
+
+            # If another kiosk compacted the journal while we were reading data.json, what we loaded is already old,
+            # so we leave the counter file alone (the next time the book data is used it is loaded again)
+            if self.get_file_signature(self.path) != self.file_signature:
+                self.counter_changes = None
+                return
+
+            rows, changes, signature, pending_signature = self.counters.read_header()
+
+            if self.file_signature in (signature, pending_signature):
+                # Counter files from before there was a row ids file get one now (the counts of the books are still the ones of data.json)
+                if not os.path.exists(self.row_ids_path):
+                    self.write_file_atomically(self.row_ids_path, self.format_row_ids(range(min(rows, len(self.row_ids)))))
+
+                # The rows belong to this data.json (or to the data.json a compaction just wrote) so they have the newest counts
+                data = self.counters.read_rows(min(rows, len(self.row_ids)))
+                for row, (available_count, rented_count) in enumerate(ROW.iter_unpack(data)):
+                    book = self.book_data[self.row_ids[row]]
+                    book.available_count = available_count
+                    book.rented_count = rented_count
+                    self.update_indexes(self.row_ids[row])
+
+                # If a compaction stopped right after it replaced data.json, write the row ids file with the counts of the new data.json
+                # (they are the counts of the rows) and mark the rows as belonging to it
+                if self.file_signature != signature:
+                    self.write_file_atomically(self.row_ids_path, self.format_row_ids(range(min(rows, len(self.row_ids)))))
+                    self.counters.write_header(rows, changes, self.file_signature)
+
+                # Write the rows of the books that dont have one yet (if a kiosk stopped between adding a book to the journal and writing its row)
+                self.counter_changes = changes
+                self.counter_rows = bytearray(data)
+                if rows < len(self.row_ids):
+                    self.write_counters([])
+            else:
+                # The counter file is new, or data.json was changed outside of this program. The rents and returns since the last
+                # compaction are only in the counter file (data.json has older counts) and the changes made by hand are only in data.json,
+                # so every book that already had a row gets the counts of its row plus how much its counts in data.json changed since
+                # the row was written (rows from before the row ids file had the counts just keep their counts), the books that didnt have
+                # one take the counts of data.json and the journal. Then all the rows are written again in the order of the new data.json
+                old_rows = {}
+                row_book_ids = self.read_row_ids()
+                for row, row_counts in enumerate(ROW.iter_unpack(self.counters.read_rows(rows))):
+                    if row in row_book_ids:
+                        book_id, base_counts = row_book_ids[row]
+                        old_rows[book_id] = (row_counts, base_counts)
+                counts = {}
+                file_counts = {}
+                for row, book_id in enumerate(self.row_ids):
+                    book = self.book_data[book_id]
+                    file_counts[book_id] = (book.available_count, book.rented_count)
+                    if book_id in old_rows:
+                        (available_count, rented_count), base_counts = old_rows[book_id]
+                        if base_counts is not None:
+                            available_count = max(0, available_count + book.available_count - base_counts[0])
+                            rented_count = max(0, rented_count + book.rented_count - base_counts[1])
+                        book.available_count, book.rented_count = available_count, rented_count
+                        self.update_indexes(book_id)
+                    counts[row] = (book.available_count, book.rented_count)
+                self.counters.write_rows(counts)
+                self.write_file_atomically(self.row_ids_path, self.format_row_ids(range(len(self.row_ids)), file_counts))
+                self.counters.write_header(len(self.row_ids), changes + 1, self.file_signature)
+                self.counter_changes = changes + 1
+                self.counter_rows = bytearray(self.counters.read_rows(len(self.row_ids)))
+
+    def read_row_ids(self):
+        # Return row number -> (book id, the counts data.json had for it) of the counter file, the counts are None in the lines
+        # written before the row ids file had them (a line that was cut in the middle is skipped)
+        row_book_ids = {}
+        if os.path.exists(self.row_ids_path):
+            with open(self.row_ids_path, "rb") as f:
+                for line in f:
+                    if line.endswith(b"\n"):
+                        row, book_id, *base_counts = json.loads(line)
+                        row_book_ids[row] = (book_id, tuple(base_counts) if base_counts else None)
+        return row_book_ids
+
+    def format_row_ids(self, rows, file_counts=None):
+        # The lines of the row ids file for the rows, with the counts data.json and the journal have for every book. Those are the
+        # counts the books have in the book data, except for the books in file_counts (book id -> counts) whose counts already changed
+        file_counts = file_counts or {}
+        lines = []
+        for row in rows:
+            book_id = self.row_ids[row]
+            book = self.book_data[book_id]
+            available_count, rented_count = file_counts.get(book_id) or (book.available_count, book.rented_count)
+            lines.append(json.dumps([row, book_id, available_count, rented_count]) + "\n")
+        return "".join(lines).encode()
+
+    def get_snapshot_tag(self):
+        # The tag of the snapshot of the catalog we have now: the modification time, size and hash of data.json and how much of the journal we applied
+        return {
+            "data_mtime": self.file_signature[1],
+            "data_size": self.file_signature[2],
+            "data_hash": self.file_hash,
+            "journal_inode": self.journal_inode,
+            "journal_offset": self.journal_offset
+        }
+
+    def load_snapshot(self, data_file, stat):
+        # Load the catalog from the snapshot file if it was made from this data.json (data_file is the open data.json), otherwise return None
+        if not os.path.exists(self.snapshot_path):
+            return None
+        try:
+            with METRICS.timer("storage_read_seconds", {"file": os.path.basename(self.snapshot_path)}), open(self.snapshot_path, "rb") as f:
+
+                # The file has the tag first, so we can check it without loading the whole snapshot
+                tag = pickle.load(f)
+                if (tag["data_mtime"], tag["data_size"]) != (stat.st_mtime_ns, stat.st_size):
+                    return None
+
+                # The journal must still be the one the snapshot has the start of
+                journal_signature = self.get_file_signature(self.journal_path)
+                if tag["journal_inode"] != (journal_signature[0] if journal_signature else None) or (journal_signature or (0, 0, 0))[2] < tag["journal_offset"]:
+                    return None
+
+                # The modification time can stay the same when a file is changed (like when it is copied with its times),
+                # so we check the hash of data.json too (hashing is much faster than parsing)
+                data_hash = hashlib.sha256()
+                for block in iter(lambda: data_file.read(1024 * 1024), b""):
+                    data_hash.update(block)
+                if data_hash.hexdigest() != tag["data_hash"]:
+                    data_file.seek(0)
+                    return None
+
+                snapshot = pickle.load(f)
+        except (OSError, EOFError, KeyError, TypeError, pickle.UnpicklingError):
+            # A broken snapshot file is never a problem, we just parse data.json
+            data_file.seek(0)
+            return None
+
+        # The books are kept as tuples of the BookRecord fields in the snapshot (that is much faster to load than pickled objects)
+        self.book_data = {row[1]: BookRecord(*row) for row in snapshot["books"]}
+        self.file_hash = tag["data_hash"]
+        self.journal_inode = tag["journal_inode"]
+        self.journal_offset = tag["journal_offset"]
+        self.snapshot_tag = tag
+        self.index_snapshot = {"index": snapshot["index"], "added_ids": []} if snapshot["index"] else None
+        METRICS.increment("snapshot_loads_total")
+        return snapshot
+
+    def take_index_snapshot(self):
+        with self.lock:
+            index_snapshot = self.index_snapshot
+            self.index_snapshot = None
+            return index_snapshot
+
+    def save_snapshot(self, search_index):
+        if not self.snapshot_path:
+            return
+        with self.lock:
+
+            # Only save the snapshot if the catalog changed since the snapshot we loaded or saved
+            self.get_book_data()
+            tag = self.get_snapshot_tag()
+            if tag == self.snapshot_tag or self.file_hash is None:
+                return
+
+            # The tag and the snapshot are pickled one after the other into the same file
+            books = [
+                (book.name, book.id, book.available_count, book.rented_count, book.release_date, book.description, book.author)
+                for book in self.book_data.values()
+            ]
+            index = search_index.get_state() if search_index else None
+            content = pickle.dumps(tag, pickle.HIGHEST_PROTOCOL) + pickle.dumps({"books": books, "index": index}, pickle.HIGHEST_PROTOCOL)
+            self.write_file_atomically(self.snapshot_path, content)
+            self.snapshot_tag = tag
+
+    def sync_counters(self):
+        # Read the counts that other kiosks changed since we last read the counter file. We compare the rows with our copy
+        # a page at a time (comparing bytes is very fast) and only go over the books of the pages that are different
+        rows, changes = self.counters.read_header()[:2]
+        data = self.counters.read_rows(min(rows, len(self.row_ids)))
+        METRICS.increment("bytes_read_total", HEADER.size + len(data), {"file": "data.counters"})
+        page_size = 4096
+        for start in range(0, len(data), page_size):
+            page = data[start:start + page_size]
+            if page == self.counter_rows[start:start + page_size]:
+                continue
+            for i, (available_count, rented_count) in enumerate(ROW.iter_unpack(page)):
+                book_id = self.row_ids[start // ROW.size + i]
+                book = self.book_data[book_id]
+                if book.available_count != available_count or book.rented_count != rented_count:
+                    book.available_count = available_count
+                    book.rented_count = rented_count
+                    self.update_indexes(book_id)
+                    self.changed()
+
+        self.counter_rows = bytearray(data)
+        self.counter_changes = changes
+
+    def write_counters(self, rows, file_counts=None):
+        # Write the counts of the given rows (and of the books that dont have a row yet) to the counter file,
+        # this is only called while the lock file is locked. file_counts has the counts of the journal for the new books
+        # that were already rented or returned in the same batch they were added in (book id -> counts)
+        row_count, changes, signature = self.counters.read_header()[:3]
+
+        # The new rows are written to the row ids file first, so every row of the counter file has its book id
+        if row_count < len(self.row_ids):
+            content = self.format_row_ids(range(row_count, len(self.row_ids)), file_counts)
+            with open(self.row_ids_path, "ab") as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            METRICS.increment("bytes_written_total", len(content), {"file": "data.counters.ids"})
+
+        counts = {}
+        for row in set(rows) | set(range(row_count, len(self.row_ids))):
+            book = self.book_data[self.row_ids[row]]
+            counts[row] = (book.available_count, book.rented_count)
+        # The new change number in the header tells the other kiosks that they have to read the counter file again,
+        # the rows and the header are synced to the disk together
+        with METRICS.timer("storage_write_seconds", {"file": "data.counters"}):
+            self.counters.write_rows(counts, (max(row_count, len(self.row_ids)), changes + 1, signature))
+        self.counter_changes = changes + 1
+        METRICS.increment("bytes_written_total", HEADER.size + len(counts) * ROW.size, {"file": "data.counters"})
+
+        # Update our copy of the rows
+        if len(self.counter_rows) < len(self.row_ids) * ROW.size:
+            self.counter_rows.extend(bytes(len(self.row_ids) * ROW.size - len(self.counter_rows)))
+        for row, (available_count, rented_count) in counts.items():
+            ROW.pack_into(self.counter_rows, row * ROW.size, available_count, rented_count)
+
+    def make_record(self, obj):
+        # json calls this for every object it parses, the book dictionaries become book records and the
+        # outer dictionary (book id -> book) stays a dictionary
+        if "rented_count" in obj and not isinstance(obj["rented_count"], BookRecord):
+            return BookRecord.from_dict(obj)
+        return obj
+
+    def replay_journal(self, notify=True):
+
+        # If there is no journal there is nothing to apply
+        if not os.path.exists(self.journal_path):
+            self.journal_inode = None
+            self.journal_offset = 0
+            return
+
+        with open(self.journal_path, "rb") as f:
+
+            # If the journal was replaced or got shorter than what we applied it means it was compacted, so we start from the beginning
+            stat = os.fstat(f.fileno())
+            if stat.st_ino != self.journal_inode or stat.st_size < self.journal_offset:
+                self.journal_inode = stat.st_ino
+                self.journal_offset = 0
+
+            # Only read the part of the journal we didnt apply yet
+            f.seek(self.journal_offset)
+            for line in f:
+
+                # If the last line doesnt end with a new line it is still being written, so we leave it for next time
+                if not line.endswith(b"\n"):
+                    break
+
+                self.apply_record(json.loads(line), notify)
+                self.journal_offset += len(line)
+                METRICS.increment("bytes_read_total", len(line), {"file": "data.journal"})
+
+    def apply_record(self, record, notify=True):
+        self.changed()
+        # The records store the counts after the change (and not just "add one"), that way applying
+        # the same record twice gives the same result
+        if record["op"] == "add_new":
+            book = BookRecord.from_dict(record["book"])
+            self.book_data[record["id"]] = book
+            self.update_indexes(record["id"])
+
+            # If the search index still has to take the index of the snapshot, it has to index this book on top of it
+            if self.index_snapshot is not None:
+                self.index_snapshot["added_ids"].append(record["id"])
+
+            # Let the listeners know a book was added
+            if notify:
+                self.notify_added(record["id"], book)
+        else:
+            book = self.book_data[record["id"]]
+            book.available_count = record["available_count"]
+            book.rented_count = record["rented_count"]
+            self.update_indexes(record["id"])
+
+    def build_record(self, action, book_id, book, pending):
+
+        # Build the journal record of the change, or return None if the change is not possible.
+        # pending has the counts of the books that were already changed by earlier changes of the same batch
+        current = pending.get(book_id) or self.book_data.get(book_id)
+        if action == "add_new":
+            if current is None:
+                # (the book goes through BookRecord first, so a book with missing fields fails here and never gets into the journal)
+                return {"op": action, "id": book_id, "book": BookRecord.from_dict(book).to_dict()}
+
+            # Another kiosk added a book with the same id after the librarian checked it (while they typed in the book data),
+            # replacing it would lose its copies, so we add one more copy of it instead (like add_book does for an existing id)
+            action = "add_old"
+
+        if current is None:
+            return None
+        available_count = current["available_count"]
+        rented_count = current["rented_count"]
+
+        # rent moves one book from available to rented, return moves it back and add_old adds one to the available books
+        # (you cant rent a book that has no available copies or return a book nobody rented)
+        if action == "rent":
+            if available_count <= 0:
+                return None
+            available_count, rented_count = available_count - 1, rented_count + 1
+        elif action == "return":
+            if rented_count <= 0:
+                return None
+            available_count, rented_count = available_count + 1, rented_count - 1
+        elif action == "add_old":
+            available_count += 1
+
+        return {"op": action, "id": book_id, "available_count": available_count, "rented_count": rented_count}
+
+    def mutate_many(self, changes):
+        # The changes are built without locking anything (optimistically), and the lock file is only locked while we commit them.
+        # If another kiosk committed something in between we load its changes and try again
+        while True:
+            with self.lock:
+
+                # Load the changes of the other kiosks and build the records from the newest book data
+                self.get_book_data()
+                records = []
+                results = []
+                pending = {}
+                for action, book_id, book in changes:
+                    record = self.build_record(action, book_id, book, pending)
+                    results.append(record is not None)
+                    if record is not None:
+                        records.append(record)
+                        pending[book_id] = record.get("book", record)
+                if not records:
+                    return results
+
+                # Only the new books go into the journal, the counts of all the changes go into the counter file
+                lines = b"".join((json.dumps(record) + "\n").encode() for record in records if record["op"] == "add_new")
+
+                with self.file_lock():
+
+                    # If a kiosk stopped in the middle of an append, cut its half line off first
+                    self.truncate_torn_journal()
+
+                    # If the catalog changed since we read it our records might be wrong (like renting the last copy
+                    # that someone else just rented), so we try again
+                    if not self.is_up_to_date():
+                        continue
+
+                    # Append all the new books to the journal with one write (every record is one small line,
+                    # so the write only depends on the size of the changes and not on the size of the catalog)
+                    if lines:
+                        with METRICS.timer("storage_write_seconds", {"file": "data.journal"}), open(self.journal_path, "ab") as f:
+                            f.write(lines)
+                            f.flush()
+                            os.fsync(f.fileno())
+                            self.journal_inode = os.fstat(f.fileno()).st_ino
+                        self.journal_offset += len(lines)
+                        METRICS.increment("bytes_written_total", len(lines), {"file": "data.journal"})
+
+                    # Apply the changes to the book data we have in memory and write the new counts of the changed books
+                    # in place in the counter file (rent and return only write the row of their book)
+                    for record in records:
+                        self.apply_record(record)
+                    self.write_counters(
+                        [self.positions[record["id"]] for record in records],
+                        {record["id"]: (record["book"]["available_count"], record["book"]["rented_count"]) for record in records if record["op"] == "add_new"}
+                    )
+
+                # If the journal got too big, fold it back into the data.json file in the background
+                if self.journal_offset > self.compact_size and not (self.compaction_thread and self.compaction_thread.is_alive()):
+                    self.compaction_thread = threading.Thread(target=self.compact)
+                    self.compaction_thread.start()
+
+                return results
+
+    def truncate_torn_journal(self):
+        # The journal is only appended to while the lock file is locked, so when we have the lock and its last line doesnt end with
+        # a new line, the kiosk that wrote it stopped in the middle of the append. Nobody will ever finish that line: we would wait
+        # for it forever and the next append would be glued onto it, so we cut the journal back to the end of its last whole line
+        # (this is only called while the lock file is locked)
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, "r+b") as f:
+            end = os.fstat(f.fileno()).st_size
+            if end == 0:
+                return
+            f.seek(end - 1)
+            if f.read(1) == b"\n":
+                return
+
+            # Go back a block at a time until we find the new line of the last whole line (or the start of the file)
+            block_size = 4096
+            position = end
+            while position > 0:
+                start = max(0, position - block_size)
+                f.seek(start)
+                block = f.read(position - start)
+                new_line = block.rfind(b"\n")
+                if new_line != -1:
+                    position = start + new_line + 1
+                    break
+                position = start
+            f.truncate(position)
+            f.flush()
+            os.fsync(f.fileno())
+        METRICS.increment("journal_truncations_total")
+
+    def compact(self):
+        with self.lock, self.file_lock():
+
+            # Load the changes of the other kiosks, then write all the book data (which has all the journal records applied
+            # and the counts of the counter file) to the data.json file.
+            # Right before data.json is replaced we write its signature to the counter file as the pending signature,
+            # and after it is replaced the rows belong to the new data.json
+            book_data = self.get_book_data()
+            rows, changes, signature = self.counters.read_header()[:3]
+            self.save_book_data(book_data, lambda new_signature: self.counters.write_header(rows, changes, signature, new_signature))
+
+            # The counts of data.json are now the counts of the rows, so the row ids file gets them too (before the rows are marked
+            # as belonging to the new data.json, if we stop in between the next kiosk that loads the catalog writes it)
+            self.write_file_atomically(self.row_ids_path, self.format_row_ids(range(len(self.row_ids))))
+            self.counters.write_header(rows, changes, self.file_signature)
+
+            # Replace the journal with an empty one, everything in it is now inside the data.json file
+            self.journal_inode = self.write_file_atomically(self.journal_path, b"")
+            self.journal_offset = 0
+
+    def write_file_atomically(self, path, content, before_replace=None):
+        with METRICS.timer("storage_write_seconds", {"file": os.path.basename(path)}):
+            inode = replace_file(path, content, before_replace)
+        METRICS.increment("bytes_written_total", len(content), {"file": os.path.basename(path)})
+        return inode
+
+    def save_book_data(self, book_data, before_replace=None):
+
+        # Update the data.json file (it is replaced as a whole)
+        # (the book records are written as book dictionaries, with the search query, exactly like add_book makes them)
+        content = json.dumps(book_data, indent=4, default=BookRecord.to_dict).encode()
+        self.write_file_atomically(self.path, content, before_replace)
+        self.file_hash = hashlib.sha256(content).hexdigest()
+
+        # Remember the new data and the new signature of the file, so we dont read back what we just wrote
+        self.book_data = book_data
+        self.file_signature = self.get_file_signature(self.path)
@@ -0,0 +1,90 @@
+import mmap
+import os
+import struct
+
+# The header of the counter file is 8 numbers: how many rows the file has, a change number that goes up with every commit,
+# the signature (inode, mtime, size) of the data.json the rows belong to, and the signature of the data.json that a
+# compaction is about to write (so if the program stops in the middle of a compaction we still know the rows are right)
+HEADER = struct.Struct("<8q")
+
+# Every row holds the available count and the rented count of one book as two 32 bit numbers,
+# row number N belongs to the N-th book of the catalog
+ROW = struct.Struct("<ii")
+
+class CounterFile:
+    def __init__(self, path):
+        # The path of the counter file, we open it the first time we need it
+        self.path = path
+        self.file = None
+        self.map = None
+
+    def open(self):
+        # Open the counter file (create it if it doesnt exist) and map it into memory, every kiosk maps the same file
+        # so a change written by one kiosk is seen by all the others right away
+        if self.map is not None:
+            return
+        self.file = os.fdopen(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644), "r+b")
+
+        # A new file gets an empty header (all zeros) and room for the first rows
+        if os.fstat(self.file.fileno()).st_size < HEADER.size:
+            self.file.truncate(HEADER.size + 1024 * ROW.size)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+
+    def remap(self):
+        # If another kiosk made the file bigger, map it again so we can see the new rows
+        if os.fstat(self.file.fileno()).st_size != len(self.map):
+            self.map.close()
+            self.map = mmap.mmap(self.file.fileno(), 0)
+
+    def read_header(self):
+        # Returns (rows, changes, signature, pending signature), a signature of zeros means there is none
+        values = HEADER.unpack_from(self.map, 0)
+        return values[0], values[1], tuple(values[2:5]), tuple(values[5:8])
+
+    def write_header(self, rows, changes, signature, pending_signature=None):
+        self.pack_header(rows, changes, signature, pending_signature)
+        self.flush_pages({0})
+
+    def pack_header(self, rows, changes, signature, pending_signature=None):
+        HEADER.pack_into(self.map, 0, rows, changes, *(signature or (0, 0, 0)), *(pending_signature or (0, 0, 0)))
+
+    def read_rows(self, count):
+        # Return the bytes of the first count rows (ROW.iter_unpack turns them into (available, rented) pairs)
+        if HEADER.size + count * ROW.size > len(self.map):
+            self.remap()
+        return self.map[HEADER.size:HEADER.size + count * ROW.size]
+
+    def write_rows(self, rows, header=None):
+        # rows is a dictionary of row number -> (available count, rented count). The counts are changed in place
+        # and only the pages that have them are written to the disk, so a rent takes the same time no matter how big the catalog is.
+        # If header is given (the arguments of write_header) the header is changed too and synced together with the rows
+        if rows:
+            self.ensure_size(max(rows) + 1)
+        pages = set()
+        for row, counts in rows.items():
+            offset = HEADER.size + row * ROW.size
+            ROW.pack_into(self.map, offset, *counts)
+            pages.add(offset // mmap.PAGESIZE)
+            pages.add((offset + ROW.size - 1) // mmap.PAGESIZE)
+        if header:
+            self.pack_header(*header)
+            pages.add(0)
+        self.flush_pages(pages)
+
+    def ensure_size(self, rows):
+        # Make the file bigger if it doesnt have room for this many rows (we double it, so it doesnt grow for every new book)
+        size = HEADER.size + rows * ROW.size
+        if size > len(self.map):
+            self.remap()
+        if size > len(self.map):
+            self.file.truncate(max(size, 2 * len(self.map)))
+            self.remap()
+
+    def flush_pages(self, pages):
+        # Write the changed pages of the file to the disk with one sync, the sync goes from the first changed page
+        # to the last one but only the pages that were changed are actually written
+        if not pages:
+            return
+        start = min(pages) * mmap.PAGESIZE
+        end = min((max(pages) + 1) * mmap.PAGESIZE, len(self.map))
+        self.map.flush(start, end - start)
@@ -0,0 +1,72 @@
+import threading
+import time
+from collections import OrderedDict
+
+class LRUCache:
+    # A cache that keeps the results of the last max_size different keys, when it is full the key that was used
+    # the longest time ago is thrown away. It counts the hits (the result was in the cache) and the misses.
+    # With max_age the keys that were not used for that many seconds are thrown away too
+
+    def __init__(self, max_size=256, max_age=None):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.items = OrderedDict()
+
+        # The time every key was last used (only with max_age)
+        self.used_at = {}
+        self.hits = 0
+        self.misses = 0
+
+        # The library server uses the cache from more than one thread
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        # Return the cached result of the key, or None if it isnt in the cache
+        with self.lock:
+            self.expire()
+            if key not in self.items:
+                self.misses += 1
+                return None
+
+            # Move the key to the end, the keys at the start are the ones that were used the longest time ago
+            self.items.move_to_end(key)
+            self.touch(key)
+            self.hits += 1
+            return self.items[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            self.touch(key)
+
+            # If the cache is too big throw away the key that was used the longest time ago
+            while len(self.items) > self.max_size:
+                self.used_at.pop(self.items.popitem(last=False)[0], None)
+            self.expire()
+
+    def pop(self, key):
+        # Throw the key away (if it is in the cache) and return its result, or None
+        with self.lock:
+            self.used_at.pop(key, None)
+            return self.items.pop(key, None)
+
+    def touch(self, key):
+        if self.max_age is not None:
+            self.used_at[key] = time.monotonic()
+
+    def expire(self):
+        # Throw away the keys that were not used for max_age seconds, they are at the start (this is only called with the lock)
+        if self.max_age is None:
+            return
+        oldest = time.monotonic() - self.max_age
+        while self.items:
+            key = next(iter(self.items))
+            if self.used_at[key] > oldest:
+                return
+            del self.items[key]
+            del self.used_at[key]
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.items), "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
@@ -1,60 +1,41 @@
-import json
 import os
-from fuzzywuzzy import fuzz
 import hashlib
+from BulkImport import BulkImporter
+from BrowseIndex import date_ordinal
+from Metrics import METRICS
 
 class Librarian:
     def __init__(self, main):
         # This is the LibraryComputer object (as we passed self to the constructor) and as you learned self is a reference to the object (the object itself)
         self.main = main
     
-    def get_book_data(self):
-
-        # Check if the data.json file exists (its the file that stores the book data), if not create it with an empty dictionary
-        if not os.path.exists("./data.json"):
-            with open("./data.json", "w+") as f:
-                json.dump({}, f, indent=4)
-        
-        # Read the data.json file and return its content as a dictionary
-        with open("./data.json", "r") as f:
-            return json.load(f)
-
     def is_id_available(self, id):
-        # Get the book data as a dictionary
-        book_data = self.get_book_data()
+        # Get the book from the catalog store (that is shared with the other role)
+        book = self.main.store.get_book(id)
 
         # Check if the id of the book exists in the book data, if not then that means the book doesn't exist thus not available
-        if not book_data.get(id):
+        if not book:
             return False
 
         # It takes the number of available books (from a certain id) and converts it to a boolean,
         # As we learned any number can be converted to a boolean, and if its bigger than 0 it means when 
         # we convert it to a boolean it will return true, otherwise it will return false
-        return bool(book_data[id]["available_count"])
+        return bool(book["available_count"])
 
     def change_book_data(self, action, data):
-        # Get the book data as a dictionary
-        book_data = self.get_book_data()
 
         # If the action is add_new (Which mean add a new book thats not in the data.json file)
         if action == "add_new":
 
-            # Add the new entry of book to the book data. dict.update: https://www.programiz.com/python-programming/methods/dictionary/update
-            book_data.update(data)
-
-            # Update the data.json file (w+ overwrites the whole file)
-            with open("./data.json", "w+") as f:
-                json.dump(book_data, f, indent=4)
+            # Add every new book entry to the catalog store
+            for book_id in data:
+                self.main.store.mutate("add_new", book_id, data[book_id])
         
         # If the action is add_old (Which mean add a book thats already in the data.json file)
         elif action == "add_old":
             
-            # Add 1 to the available count of that book
-            book_data[data]["available_count"] += 1
-
-            # Update the data.json file (w+ overwrites the whole file)
-            with open("./data.json", "w+") as f:
-                json.dump(book_data, f, indent=4)
+            # Add 1 to the available count of that book in the catalog store
+            self.main.store.mutate("add_old", data)
 
         # if the action is change_password
         elif action == "change_password":
@@ -74,27 +55,55 @@ class Librarian:
             self.change_password()
         elif option == "see book stock":
             self.see_book_stock()
+        elif option == "import books":
+            self.import_books()
+        elif option == "see metrics":
+            self.see_metrics()
+        elif option == "see overdue loans":
+            self.see_overdue_loans()
+        elif option == "see book loans":
+            self.see_book_loans()
     
     def book_exists(self, book_id):
         # Check if the book id exists in the book data
-        book_data = self.get_book_data()
-        return book_id in book_data
+        return self.main.store.get_book(book_id) is not None
+
+    def make_book(self, book_id, book_name, book_author, book_release_date, book_description):
+
+        # Check the book data, a book must have a name and a real release date in the DD/MM/YYYY format
+        if not book_id or not book_name:
+            raise ValueError("A book must have an id and a name")
+        # (date_ordinal is also what the browse index sorts the books by, so every book we add can be found by its release date)
+        if date_ordinal(book_release_date) is None:
+            raise ValueError(f"The release date {book_release_date!r} is not a date in the DD/MM/YYYY format")
+
+        # Assemble the search query with the name, author, id and description of the book and make it lower case
+        book_search_query = book_name+book_author+book_description+book_id
+        book_search_query = book_search_query.lower()
+
+        # Put all the book data into a dictionary
+        return {
+            "name": book_name,
+            "id": book_id,
+            "available_count": 1,
+            "rented_count": 0,
+            "release_date": book_release_date,
+            "description": book_description,
+            "author": book_author,
+            "search_query": book_search_query
+        }
 
     def add_book(self):
 
         # Ask the user for the book id
-        book_id = input("Please enter book id (press enter to auto generate): ")
+        book_id = self.main.ask("Please enter book id (press enter to auto generate): ")
 
         # If the book ID has not been chosen (the user just pressed enter without inputting anything)
         if book_id == "":
 
-            # Convert all book ids to integers from the book data and put the into a sorted list,
-            # then grab the last element (biggest one) and add 1 to it to create a new ID
-            # that will be the biggest one and that would ensure thats a new ID
-            id_list = int(list(self.get_book_data().keys())[-1])+1
-
-            # Convert that id to a string
-            book_id = str(id_list)
+            # Get the next id of the catalog's id sequence, the sequence only goes up
+            # so that would ensure thats a new ID
+            book_id = self.main.store.allocate_ids(1)[0]
 
             # Let the user know what ID we chose
             print(f"Id chosen: {book_id}")
@@ -109,56 +118,35 @@ class Librarian:
             
             print("Thank you, added book! (book exists)")
             print("---------------")
-            
-            # Show the user the available options again
-            self.main.role_funcs()
         else:
             # If the book is new, ask the user for all new book info
-            book_name = input("Please enter book name: ")
-            book_author = input("Please enter book author: ")
-            book_release_date = input("Please enter the book's release date (DD/MM/YYYY): ")
-            book_description = input("Please enter book description: ")
-
-            # Assemble the search query with the name, author, id and description of the book and make it lower case
-            book_search_query = book_name+book_author+book_description+book_id
-            book_search_query = book_search_query.lower()
-            
-            # Put all the book data into a dictionary
-            book_data = {
-                book_id: {
-                    "name": book_name,
-                    "id": book_id,
-                    "available_count": 1,
-                    "rented_count": 0,
-                    "release_date": book_release_date,
-                    "description": book_description,
-                    "author": book_author,
-                    "search_query": book_search_query
-                }
-            }
+            book_name = self.main.ask("Please enter book name: ")
+            book_author = self.main.ask("Please enter book author: ")
+            book_release_date = self.main.ask("Please enter the book's release date (DD/MM/YYYY): ")
+            book_description = self.main.ask("Please enter book description: ")
+
+            # Put all the book data into a dictionary (if the data is not valid print why and go back to the options)
+            try:
+                book_data = {book_id: self.make_book(book_id, book_name, book_author, book_release_date, book_description)}
+            except ValueError as error:
+                print(error)
+                print("---------------")
+                return
 
             # Call the change_book_data function with the action "add_new" and the book data so we can just add that book to the book data dict
             self.change_book_data("add_new", book_data)
 
     def see_rented_books(self):
 
-        # Get the book data as a dictionary
-        book_data = self.get_book_data()
         print("Rented books list:")
 
-        # Loop over all books
-        for book in book_data:
-
-            # Check if the book has been rented at least once
-            if book_data[book]["rented_count"] > 0:
-
-                # Print the book data for the book like this: -book name (book id): rented count
-                print(f"- {book_data[book]['name']} ({book_data[book]['id']}): {book_data[book]['rented_count']} rented")
+        # Print all books that have been rented at least once a page at a time (the store only goes over the rented books),
+        # like this: -book name (book id): rented count
+        self.main.print_paged(
+            f"- {book['name']} ({book['id']}): {book['rented_count']} rented" for book in self.main.store.iter_rented()
+        )
         print("-----------------")
 
-        # Show the user the available options again
-        self.main.role_funcs()
-
     def check_password(self, password):
 
         # Convert the given password to a 64 bit hash
@@ -181,7 +169,7 @@ class Librarian:
         if os.path.exists("./password_hash.hash"):
 
             # Ask the librarian for their current password in order to change it
-            confirmed_pass = input("Please confirm your current password: ")
+            confirmed_pass = self.main.ask("Please confirm your current password: ")
         else:
             
             # If the password has not been set before just allow the librarian to change it
@@ -191,38 +179,71 @@ class Librarian:
         if self.check_password(confirmed_pass) or allowed:
 
             # Ask the librarian for their new password
-            password = input("Enter the password you'd like: ")
+            password = self.main.ask("Enter the password you'd like: ")
 
             # Call the change_password function with the change_password action and the password 
             self.change_book_data("change_password", password)
 
             print("Thank you, password changed!")
             print("---------------")
-            
-            # Show the user the available options again
-            self.main.role_funcs()
         else:
 
-            # If the password is incorrect then print a message and show the user the available options again
+            # If the password is incorrect then print a message
             print("Password is incorrect!")
             print("---------------")
-            self.main.role_funcs()
     
     def see_book_stock(self):
 
-        # Get the book data as a dictionary
-        book_data = self.get_book_data()
         print("Available books list:")
 
-        # Loop over all books
-        for book in book_data:
+        # Print all books that have at least one available copy a page at a time (the store only goes over the books in stock),
+        # like this: -book name (book id): available count
+        self.main.print_paged(
+            f"- {book['name']} ({book['id']}): {book['available_count']} available" for book in self.main.store.iter_in_stock()
+        )
+        print("-----------------")
+
+    def import_books(self):
+
+        # Ask the librarian for the file with the books (a csv file with a header line or a jsonl file)
+        path = self.main.ask("Please enter the path of the csv/jsonl file to import: ")
+
+        # Import all the books of the file in batches, if the file cant be read print why
+        try:
+            BulkImporter(self.main, self.main.settings["import_batch_size"]).import_file(path)
+        except (OSError, ValueError) as error:
+            print(f"Could not import the file: {error}")
+        print("---------------")
 
-            # Check if at least one book of that ID is available
-            if book_data[book]["available_count"] > 0:
+    def see_metrics(self):
 
-                # Print the book data for the book like this: -book name (book id): available count
-                print(f"- {book_data[book]['name']} ({book_data[book]['id']}): {book_data[book]['available_count']} available")
+        # Print how long every option took, how much was read and written and how the searches went (in the prometheus text format),
+        # and also save them to the metrics file if there is one
+        print(METRICS.to_prometheus(), end="")
+        self.main.dump_metrics()
+        print("---------------")
+
+    def see_overdue_loans(self):
+
+        print("Overdue loans list:")
+
+        # Print all the loans that should have been returned already (the one that is late the longest first) a page at a time,
+        # like this: - book name (book id): visitor id, was due DD/MM/YYYY
+        loans = self.main.loans.overdue()
+        books = self.main.store.get_books({loan["book"] for loan in loans})
+        self.main.print_paged(
+            f"- {books[loan['book']]['name'] if loan['book'] in books else 'Unknown book'} ({loan['book']}): {loan['visitor']}, was due {self.main.visitor.format_date(loan['due_at'])}"
+            for loan in loans
+        )
         print("-----------------")
 
-        # Show the user the available options again
-        self.main.role_funcs()
\ No newline at end of file
+    def see_book_loans(self):
+
+        # Ask for the book id and print who has the copies of the book like this: - visitor id: return by DD/MM/YYYY
+        book_id = self.main.ask("Please enter book id: ")
+        loans = self.main.loans.book_loans(book_id)
+        if not loans:
+            print("Nobody has this book right now.")
+        for loan in loans:
+            print(f"- {loan['visitor']}: return by {self.main.visitor.format_date(loan['due_at'])}")
+        print("-----------------")
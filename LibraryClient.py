@@ -0,0 +1,111 @@
+import json
+import socket
+from StorageBackend import StorageBackend
+from LibraryServer import parse_address
+
+class LibraryClient(StorageBackend):
+    # A storage backend that doesnt store anything itself, it sends every request to the library server
+    # (which keeps the catalog in memory for all the kiosks) and returns its answer
+
+    def __init__(self, address):
+        super().__init__()
+        self.address = address
+
+        # Connect to the library server, with a unix socket or a tcp socket
+        server_address = parse_address(address)
+        if "unix" in server_address:
+            self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.connection.connect(server_address["unix"])
+        else:
+            self.connection = socket.create_connection((server_address["host"], server_address["port"]))
+        self.reader = self.connection.makefile("rb")
+
+    def request(self, op, **parameters):
+
+        # Send the request as one line of json and read the response line
+        self.connection.sendall((json.dumps({"op": op, **parameters}) + "\n").encode())
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError("The library server closed the connection")
+
+        response = json.loads(line)
+        if not response["ok"]:
+            raise RuntimeError(response["error"])
+        return response["result"]
+
+    def refresh(self):
+        # The server always has the newest catalog, so there is nothing to refresh
+        pass
+
+    def get_book(self, book_id):
+        return self.request("view", id=book_id)
+
+    def get_books(self, book_ids):
+        return self.request("books", ids=list(book_ids))
+
+    def allocate_ids(self, count=1):
+        return self.request("allocate_ids", count=count)
+
+    def iter_pages(self, op, page_size=100, **parameters):
+        # Ask the server for one page of books at a time, only when the previous page was used up. The server gives us a cursor
+        # with every page and goes on from where the last page stopped when we send it back (the offset is only used if the server
+        # already threw the cursor away). If we stop before the last page (the user doesnt want to see more) we tell the server
+        # to close the list, so it doesnt keep its cursor in memory
+        cursor = None
+        offset = 0
+        try:
+            while True:
+                page = self.request(op, cursor=cursor, offset=offset, limit=page_size, **parameters)
+                cursor = page["cursor"]
+                yield from page["books"]
+                if cursor is None:
+                    return
+                offset += len(page["books"])
+        finally:
+            if cursor is not None:
+                self.request("close_list", cursor=cursor)
+
+    def iter_books(self):
+        return self.iter_pages("list")
+
+    def iter_in_stock(self):
+        return self.iter_pages("stock")
+
+    def iter_rented(self):
+        return self.iter_pages("rented")
+
+    def find_books(self, search_query, limit=10, offset=0):
+        # The server has the search index so it does the search for us
+        return self.request("search", query=search_query, limit=limit, offset=offset)
+
+    def change_book_data(self, action, book_id, visitor_id=None):
+        # Rent or return the book and open or close the loan of the visitor, the server does both together
+        return self.request(f"{action}_loan", id=book_id, visitor=visitor_id)
+
+    def mutate(self, action, book_id, book=None):
+        if action == "add_new":
+            return self.request("add", id=book_id, book=book)
+        if action == "add_old":
+            return self.request("add", id=book_id)
+        return self.request(action, id=book_id)
+
+class LoanClient:
+    # The loan ledger of a client, it sends every request to the library server (which has the loan ledger) over the connection of the client
+
+    def __init__(self, client):
+        self.client = client
+
+    def borrow(self, visitor_id, book_id, days=14):
+        return self.client.request("borrow", visitor=visitor_id, id=book_id, days=days)
+
+    def close(self, book_id, visitor_id=None):
+        return self.client.request("close_loan", id=book_id, visitor=visitor_id)
+
+    def visitor_loans(self, visitor_id):
+        return self.client.request("visitor_loans", visitor=visitor_id)
+
+    def book_loans(self, book_id):
+        return self.client.request("book_loans", id=book_id)
+
+    def overdue(self, now=None):
+        return self.client.request("overdue", now=now)
@@ -0,0 +1,208 @@
+import asyncio
+import itertools
+import json
+import uuid
+from LRUCache import LRUCache
+from Metrics import METRICS
+
+def parse_address(address):
+    # The address is either "unix:/path/to/socket" for a unix socket or "host:port" for a tcp socket
+    if address.startswith("unix:"):
+        return {"unix": address[len("unix:"):]}
+    host, port = address.rsplit(":", 1)
+    return {"host": host, "port": int(port)}
+
+class LibraryServer:
+    def __init__(self, main, address):
+        # This is the LibraryComputer object that owns the catalog store, the search index and the roles,
+        # the server keeps it (and the whole catalog) in memory for all the kiosks that connect to it
+        self.main = main
+        self.address = address
+
+        # A lock for every book id that is being changed (with how many requests hold it or wait for it), so changes to the same book
+        # happen one after the other while changes to different books dont wait for each other
+        self.book_locks = {}
+
+        # The lists the kiosks are going over a page at a time (cursor id -> [the iterator of the books, how many books were sent]).
+        # Every open list keeps its iterator in memory, so a kiosk closes its list when the user stops paging, and only the lists
+        # of the last few kiosks that were used in the last few minutes are kept (for the kiosks that stopped without closing theirs)
+        self.cursors = LRUCache(main.settings["list_cursor_cache_size"], main.settings["list_cursor_seconds"])
+
+        # The operations the kiosks can ask for, every one of them gets the request dictionary and returns the result
+        self.operations = {
+            "rent": self.rent,
+            "return": self.return_,
+            "add": self.add,
+            "view": self.view,
+            "books": self.books,
+            "search": self.search,
+            "list": self.list_books,
+            "stock": self.stock,
+            "rented": self.rented,
+            "close_list": self.close_list,
+            "allocate_ids": self.allocate_ids,
+            "metrics": self.metrics,
+            "rent_loan": self.rent_loan,
+            "return_loan": self.return_loan,
+            "borrow": self.borrow,
+            "close_loan": self.close_loan,
+            "visitor_loans": self.visitor_loans,
+            "book_loans": self.book_loans,
+            "overdue": self.overdue,
+            "browse": self.browse
+        }
+
+    async def serve_forever(self):
+
+        # Start listening on the unix socket or the tcp socket
+        address = parse_address(self.address)
+        if "unix" in address:
+            server = await asyncio.start_unix_server(self.handle_client, address["unix"])
+        else:
+            server = await asyncio.start_server(self.handle_client, address["host"], address["port"])
+
+        print(f"Library server is listening on {self.address}")
+        async with server:
+            await server.serve_forever()
+
+    async def handle_client(self, reader, writer):
+        # Every kiosk sends one json request per line and gets one json response per line
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                response = await self.handle_request(line)
+                # (books can be book records, dict() turns them into book dictionaries)
+                writer.write((json.dumps(response, default=dict) + "\n").encode())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def handle_request(self, line):
+        try:
+            request = json.loads(line)
+            operation = self.operations.get(request.get("op"))
+            if operation is None:
+                return {"ok": False, "error": f"unknown operation {request.get('op')}"}
+            with METRICS.timer("server_request_seconds", {"op": request.get("op")}):
+                return {"ok": True, "result": await operation(request)}
+        except Exception as error:
+            # Send the error back to the kiosk instead of closing its connection
+            return {"ok": False, "error": str(error)}
+
+    async def run(self, function, *args):
+        # Run the function in a thread so reading and writing the files doesnt stop the server from answering other kiosks
+        return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+    async def run_locked(self, book_id, function, *args):
+        # Changes to the same book wait for each other. The lock of a book is removed when nobody holds it or waits for it anymore,
+        # otherwise there would be a lock for every book that was ever changed (all the requests run in the same thread, so nobody
+        # can take the lock between the count going to 0 and the lock being removed)
+        entry = self.book_locks.setdefault(book_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                return await self.run(function, *args)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.book_locks[book_id]
+
+    async def mutate(self, action, book_id, book=None):
+        return await self.run_locked(book_id, self.main.store.mutate, action, book_id, book)
+
+    async def rent(self, request):
+        return await self.mutate("rent", request["id"])
+
+    async def return_(self, request):
+        return await self.mutate("return", request["id"])
+
+    async def add(self, request):
+        # If the request has the book data it is a new book, otherwise we add one more copy of an existing book
+        if "book" in request:
+            return await self.mutate("add_new", request["id"], request["book"])
+        return await self.mutate("add_old", request["id"])
+
+    async def view(self, request):
+        return await self.run(self.main.store.get_book, request["id"])
+
+    async def books(self, request):
+        return await self.run(self.main.store.get_books, request["ids"])
+
+    async def search(self, request):
+        return await self.run(self.main.visitor.find_books, request["query"], request.get("limit", 10), request.get("offset", 0))
+
+    def get_page(self, make_books, request):
+        # Return one page of the books and the cursor the kiosk asks for the next page with. The cursor keeps going over the books
+        # from where the last page stopped (starting from the offset again would go over all the pages before it for every page).
+        # If the cursor was thrown away (or the kiosk doesnt have one yet) we start a new one and skip to the offset
+        offset = request.get("offset", 0)
+        limit = request.get("limit", 100)
+        cursor_id = request.get("cursor")
+        cursor = self.cursors.get(cursor_id) if cursor_id else None
+        if cursor is None or cursor[1] != offset:
+            cursor_id = uuid.uuid4().hex
+            cursor = [iter(make_books()), 0]
+        books = list(itertools.islice(cursor[0], offset - cursor[1], offset - cursor[1] + limit))
+        cursor[1] = offset + len(books)
+
+        # When the list is finished there is no next page, so we dont keep the cursor
+        if len(books) < limit:
+            self.cursors.pop(cursor_id)
+            return {"books": books, "cursor": None}
+        self.cursors.put(cursor_id, cursor)
+        return {"books": books, "cursor": cursor_id}
+
+    async def list_books(self, request):
+        return await self.run(self.get_page, self.main.store.iter_books, request)
+
+    async def stock(self, request):
+        return await self.run(self.get_page, self.main.store.iter_in_stock, request)
+
+    async def rented(self, request):
+        return await self.run(self.get_page, self.main.store.iter_rented, request)
+
+    async def close_list(self, request):
+        # The kiosk doesnt want more pages of the list, so we throw its cursor away
+        self.cursors.pop(request["cursor"])
+
+    async def allocate_ids(self, request):
+        return await self.run(self.main.store.allocate_ids, request.get("count", 1))
+
+    async def rent_loan(self, request):
+        # Rent the book and write the loan of the visitor in one request, the book stays locked until both are done
+        # (so a kiosk that stops between the two cant leave a rented copy without a loan)
+        return await self.run_locked(request["id"], self.main.visitor.change_book_data, "rent", request["id"], request["visitor"])
+
+    async def return_loan(self, request):
+        # Check and close the loan of the visitor and return the book in one request
+        return await self.run_locked(request["id"], self.main.visitor.change_book_data, "return", request["id"], request.get("visitor"))
+
+    async def borrow(self, request):
+        return await self.run(self.main.loans.borrow, request["visitor"], request["id"], request.get("days", 14))
+
+    async def close_loan(self, request):
+        return await self.run(self.main.loans.close, request["id"], request.get("visitor"))
+
+    async def visitor_loans(self, request):
+        return await self.run(self.main.loans.visitor_loans, request["visitor"])
+
+    async def book_loans(self, request):
+        return await self.run(self.main.loans.book_loans, request["id"])
+
+    async def overdue(self, request):
+        return await self.run(self.main.loans.overdue, request.get("now"))
+
+    async def browse(self, request):
+        # The books of an author or of a range of release dates, a page at a time
+        return await self.run(self.get_page, lambda: self.main.visitor.iter_browse(
+            request.get("author"), request.get("first_ordinal"), request.get("last_ordinal")
+        ), request)
+
+    async def metrics(self, request):
+        # The metrics of the server (as json), like for a monitoring script
+        return METRICS.to_dict()
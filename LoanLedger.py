@@ -0,0 +1,238 @@
+import bisect
+import json
+import os
+import threading
+import time
+import uuid
+from CatalogStore import lock_file, replace_file
+from Metrics import METRICS
+
+class LoanLedger:
+    # The record of who borrowed which book and when they have to return it. The counts of the catalog only say how many
+    # copies of a book are rented, the ledger says who has them.
+    # Every borrow and return is appended to the loans journal as one json line (so all the kiosks see the same loans),
+    # and in memory we only keep the open loans, with an index by visitor, an index by book and a sorted list of the due dates.
+    # When the journal gets too big the returned loans are moved to the history file (that is only ever appended to, it is never
+    # read when the program starts) and the journal is written again with only the open loans in it
+
+    def __init__(self, path="./loans.journal", history_path="./loans.history.jsonl", compact_size=1024 * 1024):
+        self.path = path
+        self.history_path = history_path
+        self.compact_size = compact_size
+
+        # The open loans (loan id -> loan dictionary), the ids of the open loans of every visitor and of every book
+        # (dictionaries are used as ordered sets, so the loans stay in the order they were borrowed)
+        # and a sorted list of (due time, loan id) of all the open loans
+        self.loans = {}
+        self.by_visitor = {}
+        self.by_book = {}
+        self.due_dates = []
+
+        # How many loans were returned since the journal was last compacted, when it is compacted they are read from the journal
+        # and moved to the history file (they are not kept in memory, so the memory only grows with the open loans)
+        self.returned_count = 0
+
+        # The first line of the journal and how many bytes of it we already applied. Every journal starts with a line that has
+        # a new random id, when the journal is replaced (compacted) the first line changes and we read the new journal from the beginning
+        # (we cant use the inode like the catalog store does, the file system gives the inode of a deleted journal to a new one very quickly)
+        self.journal_start = None
+        self.journal_offset = 0
+
+        # How big the journal was right after it was last compacted (the first line has it). The journal is only compacted again when it
+        # is twice that big, so when the open loans alone are bigger than compact_size every compaction still has as many bytes
+        # of returned loans to move as it has to write again (otherwise every return would write the whole journal again)
+        self.compacted_size = 0
+
+        # The lock file all the kiosks lock while they write to the journal, and the lock of the threads of this program
+        self.lock_path = path + ".lock"
+        self.lock = threading.RLock()
+
+    def file_lock(self):
+        # Lock the lock file so no other kiosk writes to the journal at the same time
+        return lock_file(self.lock_path)
+
+    def refresh(self):
+        # Apply the loans the other kiosks wrote to the journal since we last read it
+        with self.lock:
+            if not os.path.exists(self.path):
+                if self.journal_start is not None:
+                    self.clear()
+                return
+
+            with open(self.path, "rb") as f:
+
+                # If the journal was replaced (another kiosk compacted it) we read it again from the beginning
+                stat = os.fstat(f.fileno())
+                journal_start = f.readline()
+                if journal_start != self.journal_start or stat.st_size < self.journal_offset:
+                    self.clear()
+                    self.journal_start = journal_start
+                    if journal_start.endswith(b"\n"):
+                        self.compacted_size = json.loads(journal_start).get("size", 0)
+                if stat.st_size == self.journal_offset:
+                    return
+
+                f.seek(self.journal_offset)
+                for line in f:
+
+                    # If the last line doesnt end with a new line it is still being written, so we leave it for next time
+                    if not line.endswith(b"\n"):
+                        break
+                    self.apply_record(json.loads(line))
+                    self.journal_offset += len(line)
+                    METRICS.increment("bytes_read_total", len(line), {"file": "loans.journal"})
+
+    def clear(self):
+        self.loans = {}
+        self.by_visitor = {}
+        self.by_book = {}
+        self.due_dates = []
+        self.returned_count = 0
+        self.journal_start = None
+        self.journal_offset = 0
+        self.compacted_size = 0
+
+    def apply_record(self, record):
+        if record["op"] == "borrow":
+            loan = {key: record[key] for key in ("loan", "visitor", "book", "borrowed_at", "due_at")}
+            self.loans[loan["loan"]] = loan
+            self.by_visitor.setdefault(loan["visitor"], {})[loan["loan"]] = True
+            self.by_book.setdefault(loan["book"], {})[loan["loan"]] = True
+            bisect.insort(self.due_dates, (loan["due_at"], loan["loan"]))
+
+        elif record["op"] == "return":
+            loan = self.loans.pop(record["loan"], None)
+            if loan is None:
+                return
+
+            # Take the loan out of all the indexes (the empty ones are removed so they dont pile up over the years)
+            for index, key in ((self.by_visitor, loan["visitor"]), (self.by_book, loan["book"])):
+                index[key].pop(loan["loan"], None)
+                if not index[key]:
+                    del index[key]
+            position = bisect.bisect_left(self.due_dates, (loan["due_at"], loan["loan"]))
+            if position < len(self.due_dates) and self.due_dates[position] == (loan["due_at"], loan["loan"]):
+                del self.due_dates[position]
+
+            self.returned_count += 1
+
+        # (the "start" record is the first line of the journal, there is nothing to apply)
+
+    def append(self, record):
+        # Append the record to the journal (this is only called while the lock file is locked and after refresh,
+        # so we already applied everything that was written before it)
+        if not os.path.exists(self.path):
+            self.write_journal(b"")
+        line = (json.dumps(record) + "\n").encode()
+        with METRICS.timer("storage_write_seconds", {"file": "loans.journal"}), open(self.path, "ab") as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        METRICS.increment("bytes_written_total", len(line), {"file": "loans.journal"})
+        self.apply_record(record)
+        self.journal_offset += len(line)
+
+    def borrow(self, visitor_id, book_id, days=14):
+        # Record that the visitor borrowed the book (call it after the rent of the book worked), and return the loan
+        now = time.time()
+        record = {
+            "op": "borrow",
+            "loan": uuid.uuid4().hex,
+            "visitor": visitor_id,
+            "book": book_id,
+            "borrowed_at": now,
+            "due_at": now + days * 24 * 60 * 60
+        }
+        with self.lock, self.file_lock():
+            self.refresh()
+            self.append(record)
+            self.compact_if_needed()
+        return self.loans.get(record["loan"], record)
+
+    def find_loan(self, book_id, visitor_id=None):
+        # The open loan of the book by the visitor, or if we dont know the visitor (like returns from the drop box)
+        # the loan of the book that is due first
+        loans = [self.loans[loan_id] for loan_id in self.by_book.get(book_id, ())]
+        if visitor_id is not None:
+            loans = [loan for loan in loans if loan["visitor"] == visitor_id]
+        return min(loans, key=lambda loan: loan["due_at"]) if loans else None
+
+    def close(self, book_id, visitor_id=None):
+        # Record that the book was returned and return the loan, or None if there is no such open loan
+        with self.lock, self.file_lock():
+            self.refresh()
+            loan = self.find_loan(book_id, visitor_id)
+            if loan is None:
+                return None
+            self.append({"op": "return", "loan": loan["loan"], "returned_at": time.time()})
+            self.compact_if_needed()
+        return loan
+
+    def visitor_loans(self, visitor_id):
+        # What the visitor has now
+        with self.lock:
+            self.refresh()
+            return [self.loans[loan_id] for loan_id in self.by_visitor.get(visitor_id, ())]
+
+    def book_loans(self, book_id):
+        # Who has the book now
+        with self.lock:
+            self.refresh()
+            return [self.loans[loan_id] for loan_id in self.by_book.get(book_id, ())]
+
+    def overdue(self, now=None):
+        # All the loans that should have been returned before now, the one that is late the longest first
+        # (the due dates are sorted, so we only go over the overdue loans and not over all of them)
+        with self.lock:
+            self.refresh()
+            now = time.time() if now is None else now
+            return [self.loans[loan_id] for due_at, loan_id in self.due_dates[:bisect.bisect_left(self.due_dates, (now,))]]
+
+    def compact_if_needed(self):
+        # Move the returned loans to the history file and write the journal again with only the open loans
+        # (this is only called while the lock file is locked and after refresh)
+        if self.journal_offset <= max(self.compact_size, 2 * self.compacted_size) or not self.returned_count:
+            return
+
+        # First append the returned loans to the history, if we stop before the journal is replaced they are written to the history
+        # again next time (a loan id is never used twice, so whoever reads the history can skip the loans it already saw)
+        history = "".join(json.dumps(loan) + "\n" for loan in self.read_returned()).encode()
+        with METRICS.timer("storage_write_seconds", {"file": "loans.history"}), open(self.history_path, "ab") as f:
+            f.write(history)
+            f.flush()
+            os.fsync(f.fileno())
+        METRICS.increment("bytes_written_total", len(history), {"file": "loans.history"})
+
+        # Then replace the journal with one that has a borrow record of every open loan (renaming is atomic,
+        # the other kiosks see that the first line changed and read the new journal from the beginning)
+        self.write_journal("".join(json.dumps({"op": "borrow", **loan}) + "\n" for loan in self.loans.values()).encode())
+        self.returned_count = 0
+
+    def read_returned(self):
+        # Go over the journal (the part we applied) and return the loans that were borrowed and returned in it, with the time they were returned
+        borrowed = {}
+        returned = []
+        with open(self.path, "rb") as f:
+            for record in map(json.loads, f.read(self.journal_offset).splitlines()):
+                if record["op"] == "borrow":
+                    borrowed[record["loan"]] = {key: record[key] for key in ("loan", "visitor", "book", "borrowed_at", "due_at")}
+                elif record["op"] == "return" and record["loan"] in borrowed:
+                    loan = borrowed.pop(record["loan"])
+                    loan["returned_at"] = record["returned_at"]
+                    returned.append(loan)
+        METRICS.increment("bytes_read_total", self.journal_offset, {"file": "loans.journal"})
+        return returned
+
+    def write_journal(self, content):
+        # Write a new journal (with a new first line) that has the content after the first line, and replace the old one with it.
+        # The first line also has the size of the new journal, so all the kiosks know when to compact it again
+        size = len(content)
+        journal_start = (json.dumps({"op": "start", "journal": uuid.uuid4().hex, "size": size}) + "\n").encode()
+        content = journal_start + content
+        with METRICS.timer("storage_write_seconds", {"file": "loans.journal"}):
+            replace_file(self.path, content)
+        METRICS.increment("bytes_written_total", len(content), {"file": "loans.journal"})
+
+        self.journal_start = journal_start
+        self.journal_offset = len(content)
+        self.compacted_size = size
@@ -0,0 +1,117 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# The upper limits of the buckets of the histograms: seconds for the timings, and numbers of items for the counts
+SECONDS_BUCKETS = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10]
+COUNT_BUCKETS = [0, 1, 10, 100, 1000, 10000, 100000, 1000000]
+
+class Metrics:
+    # Counts and timings of what the program does (how long every option took, how many bytes were read and written,
+    # how many times the catalog was loaded, how many candidates every search scored), so when a kiosk is slow we can
+    # see where the time went. They can be written in the prometheus text format or as json
+
+    def __init__(self, prefix="library"):
+        self.prefix = prefix
+
+        # name -> {labels -> value} for the counters, and name -> {labels -> histogram} for the histograms,
+        # the labels are a tuple of (label, value) pairs like (("option", "rent book"),)
+        self.counters = {}
+        self.histograms = {}
+        self.bucket_limits = {}
+
+        # The library server records metrics from more than one thread
+        self.lock = threading.Lock()
+
+    def increment(self, name, amount=1, labels=None):
+        labels = tuple(sorted((labels or {}).items()))
+        with self.lock:
+            values = self.counters.setdefault(name, {})
+            values[labels] = values.get(labels, 0) + amount
+
+    def observe(self, name, value, labels=None, buckets=SECONDS_BUCKETS):
+        # Add a value (like how many seconds something took) to a histogram, a histogram counts how many values
+        # were in every bucket, and the sum of all of them
+        labels = tuple(sorted((labels or {}).items()))
+        with self.lock:
+            self.bucket_limits.setdefault(name, buckets)
+            histogram = self.histograms.setdefault(name, {}).get(labels)
+            if histogram is None:
+                histogram = {"buckets": [0] * (len(self.bucket_limits[name]) + 1), "sum": 0, "count": 0}
+                self.histograms[name][labels] = histogram
+
+            # The last bucket is for the values bigger than all the limits (+Inf)
+            for i, limit in enumerate(self.bucket_limits[name]):
+                if value <= limit:
+                    break
+            else:
+                i = len(self.bucket_limits[name])
+            histogram["buckets"][i] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    @contextmanager
+    def timer(self, name, labels=None):
+        # Time the code inside the "with" block and add the seconds it took to a histogram (even if it raised an error)
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start_time, labels)
+
+    def format_labels(self, labels, extra=()):
+        labels = list(labels) + list(extra)
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{label}="{str(value)}"'.replace("\n", " ") for label, value in labels) + "}"
+
+    def to_prometheus(self):
+        lines = []
+        with self.lock:
+            for name, values in sorted(self.counters.items()):
+                lines.append(f"# TYPE {self.prefix}_{name} counter")
+                for labels, value in sorted(values.items()):
+                    lines.append(f"{self.prefix}_{name}{self.format_labels(labels)} {value}")
+
+            for name, histograms in sorted(self.histograms.items()):
+                lines.append(f"# TYPE {self.prefix}_{name} histogram")
+                for labels, histogram in sorted(histograms.items()):
+                    # The buckets of the prometheus format are cumulative (every bucket has all the values up to its limit)
+                    cumulative = 0
+                    for limit, count in zip(self.bucket_limits[name] + ["+Inf"], histogram["buckets"]):
+                        cumulative += count
+                        lines.append(f"{self.prefix}_{name}_bucket{self.format_labels(labels, [('le', limit)])} {cumulative}")
+                    lines.append(f"{self.prefix}_{name}_sum{self.format_labels(labels)} {histogram['sum']}")
+                    lines.append(f"{self.prefix}_{name}_count{self.format_labels(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "counters": {
+                    name: [{"labels": dict(labels), "value": value} for labels, value in sorted(values.items())]
+                    for name, values in sorted(self.counters.items())
+                },
+                "histograms": {
+                    name: [
+                        {
+                            "labels": dict(labels),
+                            "buckets": dict(zip([str(limit) for limit in self.bucket_limits[name]] + ["+Inf"], histogram["buckets"])),
+                            "sum": histogram["sum"],
+                            "count": histogram["count"]
+                        }
+                        for labels, histogram in sorted(histograms.items())
+                    ]
+                    for name, histograms in sorted(self.histograms.items())
+                }
+            }
+
+    def dump(self, path):
+        # Write the metrics to a file, as json if the file name ends with .json and in the prometheus text format otherwise
+        content = json.dumps(self.to_dict(), indent=4) if path.endswith(".json") else self.to_prometheus()
+        with open(path, "w") as f:
+            f.write(content)
+
+# The metrics of the whole program, every part of it (the stores, the search, the roles) records into this one
+METRICS = Metrics()
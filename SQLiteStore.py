@@ -0,0 +1,279 @@
+import os
+import sqlite3
+import threading
+from StorageBackend import StorageBackend
+from CatalogStore import CatalogStore
+from Metrics import METRICS
+
+# The columns of the books table, in the same order as the keys of the book dictionaries in data.json
+BOOK_COLUMNS = ["name", "id", "available_count", "rented_count", "release_date", "description", "author", "search_query"]
+
+class SQLiteStore(StorageBackend):
+    def __init__(self, path="./data.db", json_path="./data.json", journal_path="./data.journal", counters_path="./data.counters"):
+        super().__init__()
+
+        # The path of the database file
+        self.path = path
+
+        # check_same_thread=False lets us use the connection from more than one thread, the lock makes sure
+        # only one of them uses it at a time
+        self.connection = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        self.lock = threading.RLock()
+
+        # In WAL mode the kiosks that read the database dont block the one that writes to it (and the other way around),
+        # so many kiosks can rent and return at the same time without waiting for each other's reads
+        self.connection.execute("PRAGMA journal_mode=WAL")
+
+        # The data version of the database changes whenever another connection commits a change,
+        # we use it to know when to tell the listeners that the catalog changed outside of this program
+        self.data_version = None
+
+        # The text_seq and deletes_seq sequences the last time we told the listeners about the changes (see create_tables)
+        self.text_seq = None
+        self.deletes_seq = None
+
+        self.create_tables()
+        self.migrate_from_json(json_path, journal_path, counters_path)
+
+    def create_tables(self):
+        # BEGIN IMMEDIATE takes the write lock of the database first (and waits for it), so kiosks that start at the same time
+        # create the tables one after the other instead of failing with "database is locked"
+        with self.lock, self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+
+            # The books table, every book is one row. The rowid keeps the order the books were added in
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS books (
+                    id TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    author TEXT NOT NULL,
+                    release_date TEXT NOT NULL,
+                    description TEXT NOT NULL,
+                    search_query TEXT NOT NULL,
+                    available_count INTEGER NOT NULL,
+                    rented_count INTEGER NOT NULL
+                )
+            """)
+
+            # Partial indexes that only contain the books in stock and the rented books, so the stock and rented lists dont have to
+            # go over the whole table. The indexed value ("available_count > 0") is 1 for every book in the index, so the books
+            # in the index are sorted by rowid and a page of the list (rowid > the last one, in rowid order) is one quick index lookup.
+            # (the first version indexed the counts themselves, sqlite never used those indexes for the lists so they are dropped)
+            self.connection.execute("DROP INDEX IF EXISTS books_in_stock")
+            self.connection.execute("DROP INDEX IF EXISTS books_rented")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS books_in_stock_rows ON books(available_count > 0) WHERE available_count > 0")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS books_rented_rows ON books(rented_count > 0) WHERE rented_count > 0")
+
+            # A key -> value table for information about the database itself (like if we already migrated data.json)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+            # Every book has the number of the last change to its text (name, author, release date, description or search query),
+            # the numbers come from the text_seq sequence. Rents and returns only change the counts and dont change the number,
+            # so when another kiosk changed the database we only index the books with a newer number again (and not the whole catalog).
+            # Deleted books cant be found that way, so deletes count up deletes_seq and then we index the whole catalog again.
+            # Triggers keep the numbers, so even changes made to the database by hand (like with the sqlite3 program) are seen
+            self.connection.execute("CREATE TABLE IF NOT EXISTS sequences (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            self.connection.execute("INSERT OR IGNORE INTO sequences (name, value) VALUES ('text_seq', 0), ('deletes_seq', 0)")
+            if "text_seq" not in [row[1] for row in self.connection.execute("PRAGMA table_info(books)")]:
+                self.connection.execute("ALTER TABLE books ADD COLUMN text_seq INTEGER NOT NULL DEFAULT 0")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS books_text_seq ON books(text_seq)")
+            for trigger, event in (("books_text_inserted", "INSERT"), ("books_text_updated", "UPDATE OF name, author, release_date, description, search_query")):
+                self.connection.execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS {trigger} AFTER {event} ON books BEGIN
+                        UPDATE sequences SET value = value + 1 WHERE name = 'text_seq';
+                        UPDATE books SET text_seq = (SELECT value FROM sequences WHERE name = 'text_seq') WHERE rowid = NEW.rowid;
+                    END
+                """)
+            self.connection.execute("""
+                CREATE TRIGGER IF NOT EXISTS books_deleted AFTER DELETE ON books BEGIN
+                    UPDATE sequences SET value = value + 1 WHERE name = 'deletes_seq';
+                END
+            """)
+
+    def migrate_from_json(self, json_path, journal_path, counters_path):
+        with self.lock:
+
+            # Only migrate once, and only if there is a data.json file to migrate
+            if self.connection.execute("SELECT 1 FROM meta WHERE key = 'migrated_from_json'").fetchone():
+                return
+            if not os.path.exists(json_path):
+                return
+
+            # Load data.json with its journal and its counter file on top of it and copy all the books to the database in one transaction
+            json_store = CatalogStore(json_path, journal_path, counters_path=counters_path)
+            with self.connection:
+                self.connection.executemany(
+                    f"INSERT OR IGNORE INTO books ({', '.join(BOOK_COLUMNS)}) VALUES ({', '.join('?' * len(BOOK_COLUMNS))})",
+                    ([book[column] for column in BOOK_COLUMNS] for book in json_store.iter_books())
+                )
+                self.connection.execute("INSERT INTO meta (key, value) VALUES ('migrated_from_json', ?)", (json_path,))
+
+    def row_to_book(self, row):
+        # Convert a row of the books table to a book dictionary (like the ones in data.json)
+        return dict(zip(BOOK_COLUMNS, row))
+
+    def select_books(self, where="", parameters=()):
+        with self.lock, METRICS.timer("storage_read_seconds", {"file": "sqlite"}):
+            rows = self.connection.execute(f"SELECT {', '.join(BOOK_COLUMNS)} FROM books {where} ORDER BY rowid", parameters).fetchall()
+        METRICS.increment("rows_read_total", len(rows), {"file": "sqlite"})
+        return [self.row_to_book(row) for row in rows]
+
+    def read_sequences(self):
+        return dict(self.connection.execute("SELECT name, value FROM sequences").fetchall())
+
+    def refresh(self):
+        with self.lock:
+
+            # If another connection changed the database, the catalog has a new version (so the cached searches are not used)
+            data_version = self.connection.execute("PRAGMA data_version").fetchone()[0]
+            if data_version == self.data_version:
+                return
+            self.data_version = data_version
+            self.changed()
+
+            # If books were deleted (or this is the first time) let the listeners know the whole catalog was loaded
+            sequences = self.read_sequences()
+            if self.text_seq is None or sequences["deletes_seq"] != self.deletes_seq:
+                self.text_seq = sequences["text_seq"]
+                self.deletes_seq = sequences["deletes_seq"]
+                METRICS.increment("catalog_loads_total", labels={"store": "sqlite"})
+                self.notify_loaded()
+                return
+
+            # Otherwise only tell them about the books that were added or whose text changed since last time,
+            # the rents and returns of the other kiosks dont need any indexing
+            if sequences["text_seq"] == self.text_seq:
+                return
+            with METRICS.timer("storage_read_seconds", {"file": "sqlite"}):
+                rows = self.connection.execute(
+                    f"SELECT {', '.join(BOOK_COLUMNS)} FROM books WHERE text_seq > ? ORDER BY text_seq", (self.text_seq,)
+                ).fetchall()
+            METRICS.increment("rows_read_total", len(rows), {"file": "sqlite"})
+            self.text_seq = sequences["text_seq"]
+            for row in rows:
+                book = self.row_to_book(row)
+                self.notify_added(book["id"], book)
+
+    def get_book(self, book_id):
+        books = self.select_books("WHERE id = ?", (book_id,))
+        return books[0] if books else None
+
+    def get_books(self, book_ids):
+        book_ids = list(book_ids)
+        books = {}
+
+        # Get the books in groups of 500 ids (sqlite has a limit on how many parameters a query can have)
+        for i in range(0, len(book_ids), 500):
+            group = book_ids[i:i+500]
+            for book in self.select_books(f"WHERE id IN ({', '.join('?' * len(group))})", group):
+                books[book["id"]] = book
+        return books
+
+    def allocate_ids(self, count=1):
+        with self.lock:
+
+            # BEGIN IMMEDIATE locks the database for writing right away, so two kiosks never reserve the same ids
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                # Read the next id of the sequence, if there is none yet we start it after the biggest numeric id
+                # of the catalog (this is the only time we go over all the ids)
+                row = self.connection.execute("SELECT value FROM meta WHERE key = 'next_id'").fetchone()
+                if row:
+                    next_id = int(row[0])
+                else:
+                    next_id = self.first_free_id(book_id for (book_id,) in self.connection.execute("SELECT id FROM books"))
+
+                # Take ids from the sequence, and skip the ones the librarian already gave to a book by hand
+                book_ids = []
+                while len(book_ids) < count:
+                    if not self.connection.execute("SELECT 1 FROM books WHERE id = ?", (str(next_id),)).fetchone():
+                        book_ids.append(str(next_id))
+                    next_id += 1
+
+                self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('next_id', ?)", (str(next_id),))
+                self.connection.commit()
+            except BaseException:
+                self.connection.rollback()
+                raise
+
+        return book_ids
+
+    def iter_select(self, condition="1", page_size=500):
+        # Go over the books that match the condition a page at a time, every page starts after the rowid
+        # the last page ended at, so we never hold more than one page in memory (and every page is a quick index lookup)
+        last_rowid = -1
+        while True:
+            with self.lock, METRICS.timer("storage_read_seconds", {"file": "sqlite"}):
+                rows = self.connection.execute(
+                    f"SELECT rowid, {', '.join(BOOK_COLUMNS)} FROM books WHERE ({condition}) AND rowid > ? ORDER BY rowid LIMIT ?",
+                    (last_rowid, page_size)
+                ).fetchall()
+            METRICS.increment("rows_read_total", len(rows), {"file": "sqlite"})
+            for row in rows:
+                yield self.row_to_book(row[1:])
+            if len(rows) < page_size:
+                return
+            last_rowid = rows[-1][0]
+
+    def iter_books(self):
+        return self.iter_select()
+
+    def iter_in_stock(self):
+        # The "(available_count > 0) = 1" is what lets sqlite use the books_in_stock_rows index (it only uses an index on
+        # an expression when the query compares the same expression to a value)
+        return self.iter_select("available_count > 0 AND (available_count > 0) = 1")
+
+    def iter_rented(self):
+        return self.iter_select("rented_count > 0 AND (rented_count > 0) = 1")
+
+    def mutate_many(self, changes):
+        results = []
+
+        # The books that were really added (and not only got one more copy)
+        added = []
+        with self.lock, METRICS.timer("storage_write_seconds", {"file": "sqlite"}), self.connection:
+
+            # Every change is one small statement and the whole batch is one transaction, the conditions in the WHERE
+            # make sure we never rent a book that has no available copies or return a book nobody rented
+            for action, book_id, book in changes:
+                if action == "rent":
+                    cursor = self.connection.execute(
+                        "UPDATE books SET available_count = available_count - 1, rented_count = rented_count + 1 WHERE id = ? AND available_count > 0",
+                        (book_id,)
+                    )
+                elif action == "return":
+                    cursor = self.connection.execute(
+                        "UPDATE books SET available_count = available_count + 1, rented_count = rented_count - 1 WHERE id = ? AND rented_count > 0",
+                        (book_id,)
+                    )
+                elif action == "add_old":
+                    cursor = self.connection.execute("UPDATE books SET available_count = available_count + 1 WHERE id = ?", (book_id,))
+                elif action == "add_new":
+                    # If another kiosk added a book with the same id after the librarian checked it, we add one more copy of it
+                    # (like add_old) instead of replacing it and losing its copies
+                    cursor = self.connection.execute(
+                        f"INSERT OR IGNORE INTO books ({', '.join(BOOK_COLUMNS)}) VALUES ({', '.join('?' * len(BOOK_COLUMNS))})",
+                        [book[column] for column in BOOK_COLUMNS]
+                    )
+                    if cursor.rowcount > 0:
+                        added.append((book_id, book))
+                    else:
+                        cursor = self.connection.execute("UPDATE books SET available_count = available_count + 1 WHERE id = ?", (book_id,))
+                results.append(cursor.rowcount > 0)
+
+            if any(results):
+                self.changed()
+
+            # Every book we added counted up text_seq by one (and nobody else can change the database before we commit), if the rest
+            # of text_seq is what we already know about the books we add dont have to be indexed again by our next refresh
+            # (we tell the listeners about them below)
+            if added and self.text_seq is not None:
+                text_seq = self.read_sequences()["text_seq"]
+                if text_seq - len(added) == self.text_seq:
+                    self.text_seq = text_seq
+
+        # Let the listeners know about the books that were added
+        for book_id, book in added:
+            self.notify_added(book_id, book)
+
+        return results
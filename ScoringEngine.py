@@ -0,0 +1,75 @@
+import heapq
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+def score_chunk(query, items, scorer_name, threshold, limit):
+
+    # Get the fuzzywuzzy function we score with (like "ratio" or "partial_ratio"), fuzzywuzzy is only imported the first time
+    # something is scored (importing it takes a while and many sessions never search or mistype an option)
+    from fuzzywuzzy import fuzz
+    scorer = getattr(fuzz, scorer_name)
+
+    # Score every (position, key, text) item in the chunk and keep only the ones above the threshold,
+    # if there is a limit we keep them in a heap that never gets bigger than the limit (the worst match is always
+    # at the top of the heap so we can throw it away when a better one comes)
+    matches = []
+    total = 0
+    for position, key, text in items:
+        score = scorer(query, text)
+        if score > threshold:
+            total += 1
+
+            # The position is negative so that when the scores are equal the item that came first wins
+            match = (score, -position, key)
+            if limit is None or len(matches) < limit:
+                heapq.heappush(matches, match)
+            elif match > matches[0]:
+                heapq.heapreplace(matches, match)
+
+    # Send back the best matches of the chunk (best first) and how many items were above the threshold
+    return sorted(matches, reverse=True), total
+
+class ScoringEngine:
+    def __init__(self, workers=None, chunk_size=2000, min_parallel_items=5000):
+        # How many processes score at the same time (None means one for every core of the computer)
+        self.workers = workers
+
+        # How many items every process scores at a time
+        self.chunk_size = chunk_size
+
+        # If there are less items than this we just score them here, starting the processes would take longer than the scoring
+        self.min_parallel_items = min_parallel_items
+
+        # The process pool is only started the first time we need it
+        self.pool = None
+
+    def get_pool(self):
+        # The processes are started with forkserver (or spawn on windows) and not forked from this process, the library server
+        # has other threads (the compaction, the shards, the requests) and a forked process can get stuck on a lock one of them was holding
+        if self.pool is None:
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context(method))
+        return self.pool
+
+    def score(self, query, texts, scorer_name, threshold, limit=None):
+        # texts is a list of (key, text) items, we return the (key, score) of the (up to limit) best items that scored above
+        # the threshold, best first (and items with the same score stay in the order they were given), and how many
+        # items scored above the threshold in total
+        items = [(position, key, text) for position, (key, text) in enumerate(texts)]
+
+        # Small inputs are scored here, big inputs are split into chunks that are scored by all the processes at the same time
+        if len(items) < self.min_parallel_items:
+            chunk_results = [score_chunk(query, items, scorer_name, threshold, limit)]
+        else:
+            chunks = [items[i:i+self.chunk_size] for i in range(0, len(items), self.chunk_size)]
+            futures = [self.get_pool().submit(score_chunk, query, chunk, scorer_name, threshold, limit) for chunk in chunks]
+            chunk_results = [future.result() for future in futures]
+
+        # Merge the best matches of every chunk into one list (every chunk is already sorted so we just merge them)
+        matches = heapq.merge(*[chunk_matches for chunk_matches, chunk_total in chunk_results], reverse=True)
+        if limit is not None:
+            matches = itertools.islice(matches, limit)
+        total = sum(chunk_total for chunk_matches, chunk_total in chunk_results)
+
+        return [(key, score) for score, position, key in matches], total
@@ -0,0 +1,154 @@
+import array
+import bisect
+import threading
+
+class SearchIndex:
+    def __init__(self, store):
+        # The catalog store we index, it tells us whenever the catalog is loaded or a book is added
+        self.store = store
+
+        # The inverted index: every 3 letters long piece of text (a trigram) -> the ids of the books that have it in their search query
+        self.trigrams = {}
+
+        # The position of every book in the catalog (so the results keep the catalog order when the scores are equal)
+        # and the search query length of every book (so we can remove it if the book is replaced)
+        self.positions = {}
+        self.book_lengths = {}
+        self.next_position = 0
+
+        # A sorted list of (search query length, book id), it is used to find the books that are shorter than the query
+        self.lengths = []
+
+        # When the index comes from a snapshot file the books of every trigram are kept packed (as the positions of the books in an
+        # array) until the trigram is used, unpacking all of them takes longer than the search itself. packed_ids is the book id of every position
+        self.packed = {}
+        self.packed_ids = []
+
+        # The lock makes sure the index is not changed while another thread (like in the library server) searches it
+        self.lock = threading.RLock()
+
+        # Make sure the store loaded the catalog, then start listening to it and index all of its books
+        # (if the store loaded the catalog from a snapshot, the snapshot has the index too and we only index the books added after it)
+        self.store.refresh()
+        self.store.listeners.append(self)
+        snapshot = self.store.take_index_snapshot()
+        if snapshot:
+            self.restore(snapshot["index"], snapshot["added_ids"])
+        else:
+            self.catalog_loaded(self.store.iter_books())
+
+    def get_trigrams(self, text):
+        # Split the text to all of its 3 letters long pieces, "dune" -> {"dun", "une"}
+        return {text[i:i+3] for i in range(len(text) - 2)}
+
+    def catalog_loaded(self, books):
+        with self.lock:
+
+            # The whole catalog was (re)loaded so we build the index from scratch
+            self.trigrams = {}
+            self.positions = {}
+            self.book_lengths = {}
+            self.next_position = 0
+            self.lengths = []
+            self.packed = {}
+            self.packed_ids = []
+            for book in books:
+                self.book_added(book["id"], book)
+
+    def book_added(self, book_id, book):
+        with self.lock:
+            self.index_book(book_id, book)
+
+    def index_book(self, book_id, book):
+
+        # If a book with that id is already indexed remove it first (so we dont keep trigrams it doesnt have anymore).
+        # This almost never happens so we just go over all the trigrams, instead of keeping the trigrams of every book in memory
+        if book_id in self.positions:
+            self.unpack_all()
+            for book_ids in self.trigrams.values():
+                book_ids.discard(book_id)
+            self.lengths.remove((self.book_lengths[book_id], book_id))
+        else:
+            self.positions[book_id] = self.next_position
+            self.next_position += 1
+
+        # Add the book id under every trigram of its search query
+        search_query = book["search_query"]
+        for trigram in self.get_trigrams(search_query):
+            self.get_book_ids(trigram).add(book_id)
+        self.book_lengths[book_id] = len(search_query)
+        bisect.insort(self.lengths, (len(search_query), book_id))
+
+    def get_book_ids(self, trigram, create=True):
+        # Get the set of the books that have the trigram, if it is still packed unpack it first
+        packed = self.packed.pop(trigram, None)
+        if packed is not None:
+            self.trigrams[trigram] = set(map(self.packed_ids.__getitem__, array.array("i", packed)))
+        if create:
+            return self.trigrams.setdefault(trigram, set())
+        return self.trigrams.get(trigram, ())
+
+    def unpack_all(self):
+        for trigram in list(self.packed):
+            self.get_book_ids(trigram)
+
+    def get_state(self):
+        # The whole index in a form that is quick to save and load (for the snapshot file), every trigram has the positions of its books
+        # packed into bytes (an array of ints), that is much smaller and faster to load than sets of book ids
+        with self.lock:
+            book_ids = sorted(self.positions, key=self.positions.__getitem__)
+            trigrams = dict(self.packed)
+            for trigram, trigram_book_ids in self.trigrams.items():
+                # (making a list first is twice as fast as filling the array from the map one item at a time)
+                trigrams[trigram] = array.array("i", list(map(self.positions.__getitem__, trigram_book_ids))).tobytes()
+            return {"book_ids": book_ids, "trigrams": trigrams, "lengths": self.lengths}
+
+    def restore(self, state, added_ids):
+        # Load the index from the state get_state made, and index the books that were added to the catalog after it was made
+        with self.lock:
+            self.trigrams = {}
+            self.packed = state["trigrams"]
+            self.packed_ids = state["book_ids"]
+            self.positions = {book_id: position for position, book_id in enumerate(self.packed_ids)}
+            self.next_position = len(self.packed_ids)
+            self.lengths = state["lengths"]
+            self.book_lengths = {book_id: length for length, book_id in self.lengths}
+            for book_id in added_ids:
+                book = self.store.get_book(book_id)
+                if book:
+                    self.index_book(book_id, book)
+
+    def min_shared_trigrams(self, query, threshold):
+
+        # partial_ratio compares the query to a piece of the book's search query with the same length. For the score to be above
+        # the threshold at most (100-threshold)% of the query letters can be missing from that piece, every missing letter
+        # breaks at most 3 trigrams of the query and every extra letter in the piece breaks at most 2 more.
+        # So a book that has less than that many of the query trigrams can never pass the threshold
+        most_missing = int(len(query) * (100 - threshold - 0.5) / 100)
+        return len(self.get_trigrams(query)) - 5 * most_missing
+
+    def get_candidates(self, query, threshold):
+        # Load the changes made to the catalog outside of this program (that updates the index too)
+        self.store.refresh()
+        with self.lock:
+            min_shared = self.min_shared_trigrams(query, threshold)
+
+            # If the query is too short to rule anything out just return every book
+            if min_shared <= 0:
+                return list(self.positions)
+
+            # Count for every book how many of the query trigrams it has
+            shared_counts = {}
+            for trigram in self.get_trigrams(query):
+                for book_id in self.get_book_ids(trigram, create=False):
+                    shared_counts[book_id] = shared_counts.get(book_id, 0) + 1
+
+            candidates = {book_id for book_id in shared_counts if shared_counts[book_id] >= min_shared}
+
+            # When the book's search query is shorter than the query, partial_ratio compares the other way around,
+            # so those books are always candidates
+            for length, book_id in self.lengths[:bisect.bisect_left(self.lengths, (len(query), ""))]:
+                candidates.add(book_id)
+
+            # Return the candidates in the same order they are in the catalog
+            return sorted(candidates, key=lambda book_id: self.positions[book_id])
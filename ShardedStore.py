@@ -0,0 +1,228 @@
+import heapq
+import json
+import os
+import shutil
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from StorageBackend import StorageBackend
+from CatalogStore import CatalogStore
+from BookRecord import BookRecord
+
+def shard_of(book_id, shard_count):
+    # The shard a book belongs to, crc32 gives the same number for the same id in every process
+    # (unlike hash(), which changes every time python starts)
+    return zlib.crc32(book_id.encode()) % shard_count
+
+def merge_key(book):
+    # The books of every shard are in the order they were added, and the ids come from a sequence that only goes up,
+    # so merging the shards by the number of the id gives (almost always) the order the books were added to the whole catalog
+    return (0, int(book["id"]), "") if book["id"].isdigit() else (1, 0, book["id"])
+
+def shard_paths(folder, shard):
+    # The data, journal, counter and (unused, the ids come from meta.json of the folder) metadata files of one shard
+    return {
+        "path": os.path.join(folder, f"data-{shard}.json"),
+        "journal_path": os.path.join(folder, f"data-{shard}.journal"),
+        "counters_path": os.path.join(folder, f"data-{shard}.counters"),
+        "meta_path": os.path.join(folder, f"data-{shard}.meta.json")
+    }
+
+def read_manifest(folder):
+    # The manifest of the shards folder has the number of shards, it is written last so a folder without it is not finished
+    manifest_path = os.path.join(folder, "shards.json")
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, "r") as f:
+        return json.load(f)
+
+def write_shards(folder, shard_count, books, next_id):
+    # Write the books to a new shards folder with shard_count shards, and put it in the place of the old one
+    # (the old folder is kept next to it with the time in its name, so nothing is ever lost)
+    new_folder = folder + ".new"
+    shutil.rmtree(new_folder, ignore_errors=True)
+    os.makedirs(new_folder)
+
+    shards = [{} for _ in range(shard_count)]
+    for book in books:
+        shards[shard_of(book["id"], shard_count)][book["id"]] = book
+    for shard, shard_books in enumerate(shards):
+        # (the same format as data.json, the counter file of every shard is built from it the first time the shard is loaded)
+        with open(shard_paths(new_folder, shard)["path"], "w") as f:
+            f.write(json.dumps(shard_books, indent=4, default=BookRecord.to_dict))
+
+    with open(os.path.join(new_folder, "meta.json"), "w") as f:
+        f.write(json.dumps({"next_id": next_id}, indent=4))
+    with open(os.path.join(new_folder, "shards.json"), "w") as f:
+        f.write(json.dumps({"shard_count": shard_count}, indent=4))
+
+    if os.path.exists(folder):
+        old_folder = f"{folder}.old-{time.strftime('%Y%m%d%H%M%S')}"
+        number = 1
+        while os.path.exists(old_folder):
+            number += 1
+            old_folder = f"{folder}.old-{time.strftime('%Y%m%d%H%M%S')}-{number}"
+        os.rename(folder, old_folder)
+    os.rename(new_folder, folder)
+
+def rebalance(folder, shard_count, source=None):
+    # Change the number of shards (or split data.json into shards if there is no shards folder yet), the kiosks must be stopped
+    # while this runs. The books are loaded from the source store (the shards folder if there is one, otherwise data.json)
+    # with their newest counts and written again into the new number of shards
+    if shard_count < 1:
+        raise ValueError(f"The number of shards must be at least 1, not {shard_count}")
+    if source is None:
+        source = ShardedStore(folder) if read_manifest(folder) else CatalogStore()
+
+    books = list(source.iter_books())
+    meta_path = source.meta_path
+    if os.path.exists(meta_path):
+        with open(meta_path, "r") as f:
+            next_id = json.load(f)["next_id"]
+    else:
+        next_id = source.first_free_id(book["id"] for book in books)
+
+    write_shards(folder, shard_count, books, next_id)
+    return len(books)
+
+class ShardedStore(StorageBackend):
+    # The catalog split into shard_count shards by the hash of the book id, every shard is a json store with its own data file,
+    # journal, counter file and lock file, so changes to books of different shards never wait for each other.
+    # The first time it is used it splits data.json into the shards (like the sqlite store copies data.json), after that
+    # the number of shards can only be changed with rebalance (python main.py --rebalance N)
+
+    def __init__(self, folder="./shards", shard_count=4, json_path="./data.json", journal_path="./data.journal", counters_path="./data.counters", compact_size=256 * 1024, id_block_size=64):
+        super().__init__()
+        self.folder = folder
+
+        # Split data.json into the shards if there is no shards folder yet (the lock file of data.json is locked so two kiosks dont do it together)
+        if read_manifest(folder) is None:
+            json_store = CatalogStore(json_path, journal_path, counters_path=counters_path)
+            with json_store.file_lock():
+                if read_manifest(folder) is None:
+                    rebalance(folder, shard_count, json_store)
+
+        # The number of shards comes from the shards folder, not from the settings (rebalance changes it)
+        self.shard_count = read_manifest(folder)["shard_count"]
+        self.shards = [CatalogStore(compact_size=compact_size, **shard_paths(folder, shard)) for shard in range(self.shard_count)]
+
+        # The shards tell us when they are loaded or a book is added and we tell our listeners. When a shard is (re)loaded we only
+        # note it and tell the listeners once after all the shards were refreshed (instead of once for every shard)
+        self.reload_pending = False
+        for shard in self.shards:
+            shard.listeners.append(self)
+
+        # The threads that refresh and change the shards at the same time
+        self.pool = ThreadPoolExecutor(max_workers=self.shard_count)
+
+        # The id sequence is shared by all the shards, it is kept in one metadata file that is locked with the lock file of the first shard
+        self.meta_path = os.path.join(folder, "meta.json")
+        self.id_block_size = id_block_size
+        self.reserved_ids = range(0)
+        self.lock = threading.RLock()
+
+    def get_shard(self, book_id):
+        return self.shards[shard_of(book_id, self.shard_count)]
+
+    def for_each_shard(self, function):
+        # Call the function with every shard at the same time and return the results in the order of the shards
+        return list(self.pool.map(function, self.shards))
+
+    def catalog_loaded(self, books):
+        self.reload_pending = True
+
+    def book_added(self, book_id, book):
+        self.notify_added(book_id, book)
+
+    def refresh(self):
+        # Refresh all the shards at the same time, the version of the catalog is the sum of the versions of the shards
+        self.for_each_shard(lambda shard: shard.refresh())
+        self.version = sum(shard.version for shard in self.shards)
+
+        # If any shard was (re)loaded let the listeners know the whole catalog was loaded
+        if self.reload_pending:
+            self.reload_pending = False
+            self.notify_loaded()
+
+    def get_book(self, book_id):
+        return self.get_shard(book_id).get_book(book_id)
+
+    def get_books(self, book_ids):
+        # Ask every shard for its books at the same time
+        shard_ids = [[] for _ in self.shards]
+        for book_id in book_ids:
+            shard_ids[shard_of(book_id, self.shard_count)].append(book_id)
+        books = {}
+        for shard_books in self.pool.map(lambda shard, ids: shard.get_books(ids) if ids else {}, self.shards, shard_ids):
+            books.update(shard_books)
+        return books
+
+    def allocate_ids(self, count=1):
+        with self.lock:
+            book_ids = []
+            while len(book_ids) < count:
+
+                # If we used all the ids we reserved, reserve a new block
+                if not self.reserved_ids:
+                    self.reserved_ids = self.reserve_ids(max(count - len(book_ids), self.id_block_size))
+
+                # Take the next reserved id, and skip it if the librarian already gave that id to a book by hand
+                book_id = str(self.reserved_ids[0])
+                self.reserved_ids = self.reserved_ids[1:]
+                if self.get_book(book_id) is None:
+                    book_ids.append(book_id)
+
+            return book_ids
+
+    def reserve_ids(self, count):
+        # Reserve a block of ids in the metadata file, like the json store does (the lock and the lock file of the first shard are locked,
+        # the lock too because the first shard counts how deep its file lock is and the other threads of this kiosk change it too)
+        with self.shards[0].lock, self.shards[0].file_lock():
+            if os.path.exists(self.meta_path):
+                with open(self.meta_path, "r") as f:
+                    meta = json.load(f)
+            else:
+                meta = {"next_id": self.first_free_id(book["id"] for book in self.iter_books())}
+
+            first_id = meta["next_id"]
+            meta["next_id"] = first_id + count
+            self.shards[0].write_file_atomically(self.meta_path, json.dumps(meta, indent=4).encode())
+
+        return range(first_id, first_id + count)
+
+    def iter_shards(self, iterate):
+        # Go over the books of all the shards merged into one list (all the shards are refreshed together first)
+        self.refresh()
+        yield from heapq.merge(*[iterate(shard) for shard in self.shards], key=merge_key)
+
+    def iter_books(self):
+        return self.iter_shards(lambda shard: shard.iter_books())
+
+    def iter_in_stock(self):
+        return self.iter_shards(lambda shard: shard.iter_in_stock())
+
+    def iter_rented(self):
+        return self.iter_shards(lambda shard: shard.iter_rented())
+
+    def mutate_many(self, changes):
+        # Split the changes by shard and save the changes of every shard at the same time (every shard has its own lock file,
+        # so they dont wait for each other), then put the results back in the order of the changes
+        # (a single change, like a rent from the menu, goes straight to its shard without the threads)
+        if len(changes) == 1:
+            return self.get_shard(changes[0][1]).mutate_many(changes)
+
+        shard_changes = [[] for _ in self.shards]
+        for index, (action, book_id, book) in enumerate(changes):
+            shard_changes[shard_of(book_id, self.shard_count)].append((index, (action, book_id, book)))
+
+        results = [False] * len(changes)
+        shard_results = self.pool.map(
+            lambda shard, items: shard.mutate_many([change for index, change in items]) if items else [],
+            self.shards,
+            shard_changes
+        )
+        for items, outcomes in zip(shard_changes, shard_results):
+            for (index, change), outcome in zip(items, outcomes):
+                results[index] = outcome
+        return results
@@ -0,0 +1,88 @@
+class StorageBackend:
+    # The base class of the places we can store the book data in (data.json with a journal, or an sqlite database).
+    # The librarian and the visitor only talk to these functions, so they dont care where the books are actually stored
+
+    def __init__(self):
+        # Objects that want to know when the catalog is loaded or a book is added (like the search index),
+        # they get catalog_loaded(books) and book_added(book_id, book) called on them
+        self.listeners = []
+
+        # If group commit is on, this is the WriteScheduler that saves the changes that arrive together with one write
+        self.write_scheduler = None
+
+        # The version of the catalog, it goes up with every change (made by this program or loaded from another kiosk),
+        # so results that were calculated for an older version (like cached search results) are never used again
+        self.version = 0
+
+    def changed(self):
+        # Called by the stores whenever the catalog changes
+        self.version += 1
+
+    def notify_loaded(self):
+        # Let the listeners know the whole catalog was (re)loaded
+        for listener in self.listeners:
+            listener.catalog_loaded(self.iter_books())
+
+    def notify_added(self, book_id, book):
+        # Let the listeners know a book was added
+        for listener in self.listeners:
+            listener.book_added(book_id, book)
+
+    def take_index_snapshot(self):
+        # If the catalog was loaded from a snapshot file that also has the search index, return {"index": ..., "added_ids": [...]}
+        # (the ids of the books added after the snapshot was made) the first time this is called, otherwise None
+        return None
+
+    def save_snapshot(self, search_index):
+        # Save the catalog and the search index to a snapshot file so the next start doesnt have to build them again,
+        # the stores that dont need a snapshot just dont do anything
+        pass
+
+    def refresh(self):
+        # Check if the catalog changed outside of this program and load the changes
+        raise NotImplementedError
+
+    def get_book(self, book_id):
+        # Return the book dictionary of the given id, or None if there is no such book
+        raise NotImplementedError
+
+    def get_books(self, book_ids):
+        # Return a dictionary of book id -> book dictionary for all the given ids that exist
+        raise NotImplementedError
+
+    def allocate_ids(self, count=1):
+        # Return a list of count new book ids (as strings) that no book has, the ids come from a sequence
+        # that only goes up, so an id is never given twice (even by different kiosks)
+        raise NotImplementedError
+
+    def first_free_id(self, book_ids):
+        # Get the biggest numeric book id and add 1 to it, this is only used once to start the id sequence of an existing catalog
+        numeric_ids = [int(book_id) for book_id in book_ids if book_id.isdigit()]
+        return max(numeric_ids) + 1 if numeric_ids else 1
+
+    def iter_books(self):
+        # Go over all the books in the order they were added
+        raise NotImplementedError
+
+    def iter_in_stock(self):
+        # Go over all the books that have at least one available copy
+        raise NotImplementedError
+
+    def iter_rented(self):
+        # Go over all the books that have at least one rented copy
+        raise NotImplementedError
+
+    def mutate(self, action, book_id, book=None):
+        # Apply a change to the catalog and save it, the action is rent, return, add_old or add_new (with the book dictionary,
+        # if a book with that id was added in the meantime it gets one more copy like add_old and is never replaced).
+        # Returns False if the change is not possible (renting a book that has no available copies or returning a book nobody rented).
+        # With group commit the change waits a few milliseconds for other changes and they are all saved together
+        if self.write_scheduler is not None:
+            return self.write_scheduler.submit(action, book_id, book)
+        return self.mutate_many([(action, book_id, book)])[0]
+
+    def mutate_many(self, changes):
+        # Apply a batch of (action, book_id, book) changes and return a list with the result of every change,
+        # the stores that can save the whole batch with one write do that instead of saving every change on its own
+        # (a store has to have its own mutate or its own mutate_many)
+        return [self.mutate(action, book_id, book) for action, book_id, book in changes]
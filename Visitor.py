@@ -1,65 +1,65 @@
-import json
-import os
-from fuzzywuzzy import fuzz
+import time
+from datetime import date
+from Metrics import METRICS, COUNT_BUCKETS
+from BrowseIndex import date_ordinal
 
 class Visitor:
     def __init__(self, main):
         # This is the LibraryComputer object (as we passed self to the constructor) and as you learned self is a reference to the object (the object itself)
         self.main = main
     
-    def get_book_data(self):
-
-        # Check if the data.json file exists (its the file that stores the book data), if not create it with an empty dictionary
-        if not os.path.exists("./data.json"):
-            with open("./data.json", "w+") as f:
-                json.dump({}, f, indent=4)
-        
-        # Read the data.json file and return its content as a dictionary
-        with open("./data.json", "r") as f:
-            return json.load(f)
-
     def is_id_available(self, id):
-        # Get the book data as a dictionary
-        book_data = self.get_book_data()
+        # Get the book from the catalog store (that is shared with the other role)
+        book = self.main.store.get_book(id)
 
         # Check if the id of the book exists in the book data, if not then that means the book doesn't exist thus not available
-        if not book_data.get(id):
+        if not book:
             return False
 
         # It takes the number of available books (from a certain id) and converts it to a boolean,
         # As we learned any number can be converted to a boolean, and if its bigger than 0 it means when 
         # we convert it to a boolean it will return true, otherwise it will return false
-        return bool(book_data[id]["available_count"])
+        return bool(book["available_count"])
 
-    def change_book_data(self, action, book_id):
-        # Get the book data as a dictionary
-        book_data = self.get_book_data()
+    def change_book_data(self, action, book_id, visitor_id=None):
+        # In client mode the library server changes the book and the loan ledger together (in one request)
+        if self.main.client_address:
+            return self.main.store.change_book_data(action, book_id, visitor_id)
 
-        # If the action is rent
+        # If the action is rent (one book moves from available to rented) apply it in the catalog store,
+        # and if it worked write the loan of the visitor in the loan ledger (with the date they have to return it)
         if action == "rent":
-
-            # Increase the number of rented books
-            book_data[book_id]["rented_count"] += 1
-
-            # Decrease the number of available books (because we just took one)
-            book_data[book_id]["available_count"] -= 1
-
-            # Update the data.json file (w+ overwrites the whole file)
-            with open("./data.json", "w+") as f:
-                json.dump(book_data, f, indent=4)
-        
-        # If the action is return
-        elif action == "return":
-
-            # Decrease the number of rented books (because we just returned one)
-            book_data[book_id]["rented_count"] -= 1
-
-            # Increase the number of available books
-            book_data[book_id]["available_count"] += 1
-            with open("./data.json", "w+") as f:
-
-                # Update the data.json file (w+ overwrites the whole file)
-                json.dump(book_data, f, indent=4)
+            if not self.main.store.mutate(action, book_id):
+                return None
+            return self.main.loans.borrow(visitor_id, book_id, self.main.settings["loan_days"])
+
+        # If the action is return (one book moves back from rented to available) first check the visitor can return it,
+        # then apply it in the catalog store and only if that worked close the loan of the visitor in the loan ledger
+        # (so a return that fails never closes a loan)
+        if action == "return":
+            allowed, loan = self.check_return(book_id, visitor_id)
+            if not allowed or not self.main.store.mutate(action, book_id):
+                return None
+            if loan:
+                loan = self.main.loans.close(book_id, loan["visitor"])
+            return loan or {"book": book_id, "visitor": visitor_id}
+
+    def check_return(self, book_id, visitor_id=None, claimed=(), pending_returns=0):
+        # Find the open loan a return of the book closes: the loan of the visitor (or if we dont know the visitor, like returns
+        # from the drop box, the loan that is due first), without the loan ids in claimed (loans that returns which are not saved yet
+        # will close). If there is no such loan it can still be a copy that was rented before there was a loan ledger (the book has
+        # more rented copies than open loans, pending_returns is how many of those copies returns which are not saved yet already took).
+        # Returns (True, the loan or None) if the return is allowed and (False, None) if it isnt
+        loans = self.main.loans.book_loans(book_id)
+        open_loans = [loan for loan in loans if loan["loan"] not in claimed and visitor_id in (None, loan["visitor"])]
+        if open_loans:
+            return True, min(open_loans, key=lambda loan: loan["due_at"])
+        book = self.main.store.get_book(book_id)
+        return bool(book) and book["rented_count"] - pending_returns > len(loans), None
+
+    def format_date(self, timestamp):
+        # Loan times are seconds since 1970, we show them like the release dates (DD/MM/YYYY)
+        return time.strftime("%d/%m/%Y", time.localtime(timestamp))
 
     def do_option(self, option):
 
@@ -74,125 +74,240 @@ class Visitor:
             self.search_book()
         elif option == "view book":
             self.view_book()
+        elif option == "see my loans":
+            self.see_my_loans()
+        elif option == "browse by author":
+            self.browse_by_author()
+        elif option == "browse by release date":
+            self.browse_by_release_date()
     
     def rent_book(self):
 
         # Ask the user for the book id
-        book_id = input("Please enter book id: ")
+        book_id = self.main.ask("Please enter book id: ")
 
-        # Check if the book id is available, if so then call the change_book_data function
-        # with the action "rent" and the chosen book_id
+        # Check if the book id is available, if so ask for the visitor id and call the change_book_data function
+        # with the action "rent", the chosen book_id and the visitor id, and tell the visitor when to return the book
         if self.is_id_available(book_id):
-            self.change_book_data("rent", book_id)
+            visitor_id = self.main.ask("Please enter your visitor id: ")
+            loan = self.change_book_data("rent", book_id, visitor_id)
+            if loan:
+                print(f"Enjoy the book! Please return it by {self.format_date(loan['due_at'])}")
+            else:
+                print("Sorry, but someone just rented the last copy of this book!")
+            print("---------------")
         else:
 
-            # If the book id is not available then print a message and show the user the available options again
+            # If the book id is not available then print a message
             print("Sorry, but we are dont have an available book with this id!")
             print("---------------")
-            self.main.role_funcs()
     
     def return_book(self):
 
         # Ask the user for the book id
-        id = input("Please enter book id: ")
+        id = self.main.ask("Please enter book id: ")
 
-        # Get book data as a dictionary
-        book_data = self.get_book_data()
+        # Get the book from the catalog store
+        book = self.main.store.get_book(id)
 
-        # Check if the book has NOT been rented at least once
-        if book_data[id]["rented_count"] <= 0:
+        # Check if the book doesnt exist or has NOT been rented at least once
+        if not book or book["rented_count"] <= 0:
 
             # If the book has NOT been rented at least once then print a message
-            # and show the user the available options again
             print("We dont have any record that you have rented this book!")
             print("---------------")
-            self.main.role_funcs()
+            return
         
-        # If the book has been rented at least once then call the change_book_data function with
-        # The action "return" and the chosen book_id
-        self.change_book_data("return", id)
+        # If the book has been rented at least once ask for the visitor id and call the change_book_data function with
+        # The action "return", the chosen book_id and the visitor id
+        visitor_id = self.main.ask("Please enter your visitor id: ")
+        if self.change_book_data("return", id, visitor_id):
+            print("Thank you for returning the book!")
+        else:
+            print("We dont have any record that you have rented this book!")
+        print("---------------")
 
     def see_book_list(self):
         print("Here is our book list:")
 
-        # Get the book data as a dictionary
-        book_data = self.get_book_data()
-
-        # Loop over all books
-        for book in book_data:
-            # the variable "book" is currently the key of the dictionary which is the book ID so I just
-            # get the data of the book by using the book ID as a key
-            book = book_data[book]
-
-            # Print the book data for the book like this: - book name (book id): available count
-            print(f"- {book['name']} ({book['id']}): {book['available_count']} available")
+        # Print all books a page at a time like this: - book name (book id): available count
+        self.main.print_paged(
+            f"- {book['name']} ({book['id']}): {book['available_count']} available" for book in self.main.store.iter_books()
+        )
         print("---------------")
-
-        # Show the user the available options again
-        self.main.role_funcs()
     
+    def find_books(self, search_query, limit=10, offset=0):
+
+        # In client mode the library server has the search index, so it searches for us
+        if self.main.client_address:
+            return self.main.store.find_books(search_query, limit, offset)
+
+        # Replace all spaces of the search query and lower case it (like the search query of the books)
+        search_query = search_query.replace(" ", "").lower()
+
+        # If the same search was done on the same version of the catalog, we already have the best matches of it (the first few pages)
+        # and how many books match in total (any change to the catalog makes a new version, so the cached matches are never old).
+        # Only the pages we need are ranked, when the visitor goes past the pages we have we rank the search again with twice as many
+        self.main.store.refresh()
+        cache_key = (search_query, self.main.store.version)
+        cached = self.main.search_cache.get(cache_key)
+        if cached is not None and (len(cached[0]) >= offset + limit or len(cached[0]) == cached[1]):
+            METRICS.increment("search_cache_total", labels={"result": "hit"})
+            ranking, total = cached
+        else:
+            METRICS.increment("search_cache_total", labels={"result": "miss"})
+            rank_limit = max(offset + limit, self.main.settings["search_rank_pages"] * limit, 2 * len(cached[0]) if cached else 0)
+            ranking, total = self.rank_books(search_query, rank_limit)
+            self.main.search_cache.put(cache_key, (ranking, total))
+
+        # Get the books of the page that was asked for and return them with the total number of matching books
+        search_ratios = ranking[offset:offset + limit]
+        book_data = self.main.store.get_books([book for book, score in search_ratios])
+        return {
+            "results": [{"book": book_data[book], "score": score} for book, score in search_ratios if book in book_data],
+            "total": total
+        }
+
+    def rank_books(self, search_query, limit):
+        fuzzy_threshold = 80
+
+        # Get the books that share enough trigrams with the search query (the search index rules out
+        # the books that can never pass the fuzzy threshold, so we dont have to score every book)
+        candidates = self.main.search_index.get_candidates(search_query, fuzzy_threshold)
+        book_data = self.main.store.get_books(candidates)
+        METRICS.observe("search_candidates", len(candidates), buckets=COUNT_BUCKETS)
+
+        # Score the search query against the search query of every candidate (which is the book name, description, and author with no spaces),
+        # partial ratio just ignores if theres extra data, if some of it is there then its 100%, its good because we just have a big string of every data of the book.
+        # The scoring engine gives back the (book id, score) of the (up to limit) best books with a score greater than the fuzzy threshold, best first,
+        # and how many books scored greater than the threshold
+        with METRICS.timer("search_scoring_seconds"):
+            return self.main.scoring_engine.score(
+                search_query,
+                [(book, book_data[book]['search_query']) for book in candidates if book in book_data],
+                "partial_ratio",
+                fuzzy_threshold,
+                limit
+            )
+
     def search_book(self):
 
-        # Ask the user for the search query, replace all spaces and lower case it
-        search_query = input("Please enter search query: ").replace(" ", "").lower()
+        # Ask the user for the search query
+        search_query = self.main.ask("Please enter search query: ")
+        page_size = self.main.settings["search_page_size"]
+        offset = 0
 
-        # Get the book data as a dictionary
-        book_data = self.get_book_data()
-        search_ratios = []
-        fuzzy_threshold = 80
+        while True:
 
-        # Loop over all books
-        for book in book_data:
+            # Get the current page of results
+            page = self.find_books(search_query, page_size, offset)
 
-            # Append to the search_ratios list the book id and ratio between the search query and the book search query which is the book name, description, and author with no spaces
-            search_ratios.append({
-                "book": book,
-                "score": fuzz.partial_ratio(search_query, book_data[book]['search_query']) # partial ratio just ignores if theres extra data, if some of it is there then its 100%, its good because we just have a big string of every data of the book
-            })
+            # Loop over all books in the page and print the book data for the book like this: - book name (book id): available count
+            for result in page["results"]:
+                book = result["book"]
+                print(f"- {book['name']} ({book['id']}): {book['available_count']} available")
+            print("--------------------")
 
-        # Sort the search_ratios list by the match score
-        search_ratios = sorted(search_ratios, key=lambda k: k["score"], reverse=True)
+            # If there are more results ask the user if they want to see the next page
+            offset += page_size
+            if offset >= page["total"]:
+                break
+            if self.main.ask(f"Showing {offset} of {page['total']} results, see the next page? (y/n): ").lower() != "y":
+                break
 
-        # Replace every item in the list with None if the score is lower than the fuzzy threshold
-        search_ratios = map(lambda k: k if k["score"] > fuzzy_threshold else None, search_ratios)
-        
-        # Loop over all books in the search_ratios list
-        for book in search_ratios:
-            
-            # If the current item is not None then print the book data for the book like this: - book name (book id): available count
-            if book:
-                book = book['book']
-                print(f"- {book_data[book]['name']} ({book_data[book]['id']}): {book_data[book]['available_count']} available")
-        print("--------------------")
-        
-        # Show the user the available options again
-        self.main.role_funcs()
+    def iter_browse(self, author=None, first_ordinal=None, last_ordinal=None):
+        # Go over the books of the author, or the books released between the two date ordinals (from the oldest to the newest)
+
+        # In client mode the library server has the browse index, so it finds the books for us
+        if self.main.client_address:
+            return self.main.store.iter_pages("browse", author=author, first_ordinal=first_ordinal, last_ordinal=last_ordinal)
+
+        # The browse index finds the ids of the books without going over the whole catalog, then we get the books a page at a time
+        if author is not None:
+            book_ids = self.main.browse_index.by_author(author)
+        else:
+            book_ids = self.main.browse_index.by_dates(first_ordinal, last_ordinal)
+        return self.iter_book_ids(book_ids)
+
+    def iter_book_ids(self, book_ids, page_size=100):
+        for start in range(0, len(book_ids), page_size):
+            books = self.main.store.get_books(book_ids[start:start + page_size])
+            for book_id in book_ids[start:start + page_size]:
+                if book_id in books:
+                    yield books[book_id]
+
+    def parse_date_bound(self, text, last):
+        # The visitor can enter a whole date (DD/MM/YYYY) or just a year (that means from the first day of the year or
+        # up to the last day of the year), nothing means there is no limit. Returns the date ordinal or None if it is not a date
+        text = text.strip()
+        if not text:
+            return date.max.toordinal() if last else date.min.toordinal()
+        if text.isdigit() and 1 <= int(text) <= 9999:
+            return date(int(text), 12, 31).toordinal() if last else date(int(text), 1, 1).toordinal()
+        return date_ordinal(text)
+
+    def browse_by_author(self):
+
+        # Ask the user for the author and print all their books a page at a time like this: - book name (book id), release date: available count
+        author = self.main.ask("Please enter the author: ")
+        print(f"Books by {author}:")
+        self.main.print_paged(
+            f"- {book['name']} ({book['id']}), {book['release_date']}: {book['available_count']} available" for book in self.iter_browse(author=author)
+        )
+        print("---------------")
+
+    def browse_by_release_date(self):
+
+        # Ask the user for the range of release dates (the first and the last date are included)
+        first_ordinal = self.parse_date_bound(self.main.ask("Released from (DD/MM/YYYY or year, empty for no limit): "), last=False)
+        last_ordinal = self.parse_date_bound(self.main.ask("Released until (DD/MM/YYYY or year, empty for no limit): "), last=True)
+        if first_ordinal is None or last_ordinal is None:
+            print("Please enter the dates in the DD/MM/YYYY format (or just a year)!")
+            print("---------------")
+            return
+
+        # Print the books from the oldest to the newest a page at a time like this: - release date: book name (book id) by author, available count
+        self.main.print_paged(
+            f"- {book['release_date']}: {book['name']} ({book['id']}) by {book['author']}, {book['available_count']} available"
+            for book in self.iter_browse(first_ordinal=first_ordinal, last_ordinal=last_ordinal)
+        )
+        print("---------------")
 
     def view_book(self):
 
         # Ask the user for the book id
-        book_id = input("Please enter book id: ")
+        book_id = self.main.ask("Please enter book id: ")
 
-        # Get book data as a dictionary
-        book_data = self.get_book_data()
+        # Get the book from the catalog store
+        book = self.main.store.get_book(book_id)
 
         # If the book data contains the book id, print all the book data that is relevant to the visitor.
-        if book_data.get(book_id):
+        if book:
             print(f"\tBook data for ID: {book_id}")
-            print("\tBook Name: ", book_data[book_id]['name'])
-            print("\tBook Author: ", book_data[book_id]['author'])
-            print("\tBook ID: ", book_data[book_id]['id'])
-            print("\tBook Release Date: ", book_data[book_id]['release_date'])
-            print("\tBook Available Count: ", book_data[book_id]['available_count'])
-            print("\tBook Description: ", book_data[book_id]['description'])
+            print("\tBook Name: ", book['name'])
+            print("\tBook Author: ", book['author'])
+            print("\tBook ID: ", book['id'])
+            print("\tBook Release Date: ", book['release_date'])
+            print("\tBook Available Count: ", book['available_count'])
+            print("\tBook Description: ", book['description'])
             print("---------------")
-            # Show the user the available options again
-            self.main.role_funcs()
         else:
 
             # If the book is not available (at all, not just for renting) then print a message saying it doesnt exist
             print("Sorry, but we are dont have an available book with this id!")
             print("---------------")
 
-            # Show the user the available options again
-            self.main.role_funcs()  
\ No newline at end of file
+    def see_my_loans(self):
+
+        # Ask for the visitor id and print all the books the visitor has now like this: - book name (book id): return by DD/MM/YYYY
+        visitor_id = self.main.ask("Please enter your visitor id: ")
+        loans = self.main.loans.visitor_loans(visitor_id)
+        if not loans:
+            print("You dont have any books right now.")
+        books = self.main.store.get_books([loan["book"] for loan in loans])
+        now = time.time()
+        for loan in loans:
+            book = books.get(loan["book"])
+            name = book["name"] if book else "Unknown book"
+            print(f"- {name} ({loan['book']}): return by {self.format_date(loan['due_at'])}{' (overdue!)' if loan['due_at'] < now else ''}")
+        print("---------------")
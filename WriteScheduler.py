@@ -0,0 +1,65 @@
+import threading
+import time
+
+class WriteScheduler:
+    # Collects the changes that arrive at about the same time (like many kiosks renting books when the library opens)
+    # and saves them together with store.mutate_many, so the whole group costs one write and one sync to the disk
+    # instead of one for every change. Every caller still waits until its change is saved before it gets its result
+
+    def __init__(self, store, window=0, max_changes=64):
+        self.store = store
+
+        # How many seconds the first change of a group waits for more changes, and the most changes in one group
+        self.window = window
+        self.max_changes = max_changes
+
+        # The changes waiting for the next group, and if a group is being saved right now
+        self.pending = []
+        self.committing = False
+        self.condition = threading.Condition()
+
+    def submit(self, action, book_id, book=None):
+        entry = {"change": (action, book_id, book), "done": False, "result": None, "error": None}
+
+        with self.condition:
+            self.pending.append(entry)
+            self.condition.notify_all()
+
+            while not entry["done"]:
+                # If another caller is saving a group right now, wait for it (our change goes into the next group)
+                if self.committing:
+                    self.condition.wait()
+                    continue
+
+                # Otherwise we save the next group, first we wait a little for more changes to arrive
+                # (the changes that arrived while the previous group was being saved are already waiting)
+                self.committing = True
+                deadline = time.monotonic() + self.window
+                remaining = self.window
+                while len(self.pending) < self.max_changes and remaining > 0:
+                    self.condition.wait(remaining)
+                    remaining = deadline - time.monotonic()
+                group = self.pending[:self.max_changes]
+                self.pending = self.pending[self.max_changes:]
+
+                # Save the group without holding the condition, so more changes can arrive for the next group meanwhile
+                self.condition.release()
+                try:
+                    results = self.store.mutate_many([group_entry["change"] for group_entry in group])
+                    for group_entry, result in zip(group, results):
+                        group_entry["result"] = result
+                except BaseException as error:
+                    for group_entry in group:
+                        group_entry["error"] = error
+                finally:
+                    self.condition.acquire()
+
+                # Wake up the callers of the group (and the callers that wait to save the next group)
+                for group_entry in group:
+                    group_entry["done"] = True
+                self.committing = False
+                self.condition.notify_all()
+
+        if entry["error"] is not None:
+            raise entry["error"]
+        return entry["result"]
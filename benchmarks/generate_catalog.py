@@ -0,0 +1,56 @@
+import json
+import random
+import sys
+
+# usage: python benchmarks/generate_catalog.py COUNT [PATH] [SEED]
+# Writes a data.json with COUNT made up (but realistic looking) books, the books are exactly like the ones add_book makes
+# (same keys in the same order, and the same search query). The same seed always gives the same catalog
+
+FIRST_NAMES = ["Jane", "Leo", "Toni", "Gabriel", "Haruki", "Chinua", "Virginia", "Fyodor", "Isabel", "Kazuo", "Ursula", "Albert",
+               "Margaret", "Jorge", "Zadie", "Italo", "Agatha", "Mark", "Doris", "Salman", "Orhan", "Elena", "Franz", "Ray"]
+LAST_NAMES = ["Austen", "Tolstoy", "Morrison", "Garcia", "Murakami", "Achebe", "Woolf", "Dostoevsky", "Allende", "Ishiguro", "Le Guin",
+              "Camus", "Atwood", "Borges", "Smith", "Calvino", "Christie", "Twain", "Lessing", "Rushdie", "Pamuk", "Ferrante", "Kafka", "Bradbury"]
+TITLE_WORDS = ["night", "river", "garden", "house", "war", "peace", "secret", "winter", "king", "stone", "light", "sea", "shadow",
+               "city", "dream", "fire", "silence", "journey", "mountain", "child", "memory", "storm", "island", "road", "star", "glass"]
+DESCRIPTION_WORDS = TITLE_WORDS + ["a", "the", "of", "and", "in", "story", "young", "old", "family", "love", "lost", "finds",
+                                   "world", "life", "years", "between", "after", "before", "town", "friend", "truth", "long"]
+
+def make_books(count, seed=1):
+    # Go over count books one at a time (so even a million books dont have to be in memory together)
+    random_generator = random.Random(seed)
+    for i in range(1, count + 1):
+        book_id = str(i)
+        book_name = " ".join(random_generator.choice(TITLE_WORDS) for _ in range(random_generator.randint(1, 5))).title()
+        book_author = f"{random_generator.choice(FIRST_NAMES)} {random_generator.choice(LAST_NAMES)}"
+        book_release_date = f"{random_generator.randint(1, 28):02d}/{random_generator.randint(1, 12):02d}/{random_generator.randint(1850, 2024)}"
+        book_description = " ".join(random_generator.choice(DESCRIPTION_WORDS) for _ in range(random_generator.randint(10, 40))).capitalize()
+
+        # Some books are rented and some have no copies left, so the stock and rented lists have something in them
+        rented_count = random_generator.choice([0, 0, 0, 1, 1, 2, 3])
+        available_count = random_generator.choice([0, 1, 1, 2, 3, 5])
+
+        yield {
+            "name": book_name,
+            "id": book_id,
+            "available_count": available_count,
+            "rented_count": rented_count,
+            "release_date": book_release_date,
+            "description": book_description,
+            "author": book_author,
+            "search_query": (book_name + book_author + book_description + book_id).lower()
+        }
+
+def write_catalog(path, count, seed=1):
+    # Write the books one at a time in the same format as save_book_data (a dictionary of book id -> book, with an indent of 4)
+    with open(path, "w") as f:
+        f.write("{")
+        for i, book in enumerate(make_books(count, seed)):
+            f.write(("," if i else "") + json.dumps({book["id"]: book}, indent=4)[1:-2])
+        f.write("\n}")
+
+if __name__ == "__main__":
+    write_catalog(
+        sys.argv[2] if len(sys.argv) > 2 else "./data.json",
+        int(sys.argv[1]) if len(sys.argv) > 1 else 1000,
+        int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    )
@@ -0,0 +1,44 @@
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+# Run the benchmark from anywhere, the program files are one folder up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from CatalogStore import CatalogStore
+from WriteScheduler import WriteScheduler
+
+# usage: python benchmarks/group_commit_benchmark.py [threads] [changes per thread]
+# Many threads (like the kiosks connected to the library server) rent and return books at the same time,
+# once with every change saved on its own and then with group commit and different windows. Prints one json line for each
+
+def run(threads, changes, window):
+    with tempfile.TemporaryDirectory() as folder:
+        store = CatalogStore(os.path.join(folder, "data.json"), os.path.join(folder, "data.journal"),
+                             meta_path=os.path.join(folder, "data.meta.json"), counters_path=os.path.join(folder, "data.counters"))
+        store.mutate_many([("add_new", str(i), {"id": str(i), "name": f"Book {i}", "available_count": changes, "rented_count": 0}) for i in range(threads)])
+        if window is not None:
+            store.write_scheduler = WriteScheduler(store, window, 64)
+
+        # Every thread rents and returns its own book
+        def work(book_id):
+            for i in range(changes):
+                store.mutate("rent" if i % 2 == 0 else "return", book_id)
+
+        workers = [threading.Thread(target=work, args=(str(i),)) for i in range(threads)]
+        start_time = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start_time
+
+    return {"threads": threads, "changes": threads * changes, "window": window, "seconds": round(elapsed, 3), "changes_per_second": round(threads * changes / elapsed)}
+
+if __name__ == "__main__":
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    changes = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    for window in (None, 0, 0.001, 0.005):
+        print(json.dumps(run(threads, changes, window)))
@@ -0,0 +1,51 @@
+import json
+import os
+import sys
+import tracemalloc
+
+# Run the benchmark from anywhere, the program files are one folder up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from BookRecord import BookRecord
+from generate_catalog import make_books
+
+# usage: python benchmarks/memory_benchmark.py [number of books ...]
+# Prints one json line for every catalog size with the memory the catalog takes as book dictionaries (like before)
+# and as book records
+
+def measure(count, make_catalog):
+    # Build the catalog from json text (like loading data.json does) and measure how much memory it holds on to
+    lines = [json.dumps(book) for book in make_books(count)]
+    tracemalloc.start()
+    catalog = make_catalog(lines)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del catalog
+    return size
+
+def dict_catalog(lines):
+    catalog = {}
+    for line in lines:
+        book = json.loads(line)
+        catalog[book["id"]] = book
+    return catalog
+
+def record_catalog(lines):
+    catalog = {}
+    for line in lines:
+        book = json.loads(line, object_hook=BookRecord.from_dict)
+        catalog[book.id] = book
+    return catalog
+
+if __name__ == "__main__":
+    sizes = [int(size) for size in sys.argv[1:]] or [10_000, 100_000, 1_000_000]
+    for count in sizes:
+        dict_bytes = measure(count, dict_catalog)
+        record_bytes = measure(count, record_catalog)
+        print(json.dumps({
+            "books": count,
+            "dict_bytes": dict_bytes,
+            "record_bytes": record_bytes,
+            "bytes_per_book_before": round(dict_bytes / count),
+            "bytes_per_book_after": round(record_bytes / count),
+            "saved_percent": round(100 * (1 - record_bytes / dict_bytes), 1)
+        }))
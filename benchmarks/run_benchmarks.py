@@ -0,0 +1,137 @@
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+# Run the benchmarks from anywhere, the program files are one folder up
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+from main import LibraryComputer
+from CatalogStore import CatalogStore
+from SQLiteStore import SQLiteStore
+from generate_catalog import write_catalog
+
+# usage: python benchmarks/run_benchmarks.py [--sizes 1000 100000 1000000] [--backend json|sqlite] [--searches N] [--output FILE] [--compare FILE]
+# Times the main paths of the program (loading the catalog, searching, renting and returning, the stock and rented lists and
+# new book ids) on generated catalogs, and prints one json line for every benchmark. With --compare the results of an older
+# run are added to every line, and the benchmarks that got more than 20% slower are marked as a regression
+
+def git_commit():
+    # The commit the benchmarks ran on, so results can be matched to the code
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def timed(function, ops=1):
+    start_time = time.perf_counter()
+    function()
+    seconds = time.perf_counter() - start_time
+    return {"ops": ops, "seconds": round(seconds, 6), "us_per_op": round(seconds / ops * 1e6, 3)}
+
+def run_size(books, backend, seed, searches):
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)
+        write_catalog("./data.json", books, seed)
+        random_generator = random.Random(seed)
+        results = {}
+
+        # Loading the catalog: for the json store parsing data.json (the first time also builds the counter file, so we time
+        # the second load like a kiosk that starts again), for the sqlite store copying data.json into the database
+        def load():
+            if backend == "json":
+                CatalogStore("./data.json", "./data.journal", meta_path="./data.meta.json", counters_path="./data.counters").get_book_data()
+            else:
+                SQLiteStore("./data.db", "./data.json", "./data.journal", "./data.counters").connection.close()
+        if backend == "json":
+            load()
+        results["load"] = timed(load)
+
+        computer = LibraryComputer(settings={"storage_backend": backend, "menu_delay": 0})
+        store = computer.store
+        results["index_build"] = timed(lambda: computer.search_index.catalog_loaded(store.iter_books()))
+
+        # Searching for the names and authors of random books, the cache is cleared so every search is scored again
+        queries = []
+        for book_id in random_generator.sample(range(1, books + 1), min(searches, books)):
+            book = store.get_book(str(book_id))
+            queries.append(book["name"] if len(queries) % 2 else book["author"])
+
+        def search():
+            for query in queries:
+                computer.search_cache.items.clear()
+                computer.visitor.find_books(query)
+        results["search"] = timed(search, len(queries))
+
+        # The same searches again once they are all in the cache
+        for query in queries:
+            computer.visitor.find_books(query)
+        results["search_cached"] = timed(lambda: [computer.visitor.find_books(query) for query in queries], len(queries))
+
+        # Renting and returning random books, every change is saved on its own
+        book_ids = [str(random_generator.randint(1, books)) for _ in range(500)]
+        def rent_return():
+            for book_id in book_ids:
+                store.mutate("return" if store.mutate("rent", book_id) else "add_old", book_id)
+        results["rent_return"] = timed(rent_return, 2 * len(book_ids))
+
+        # Going over the whole stock list, rented list and book list
+        results["list_stock"] = timed(lambda: sum(1 for _ in store.iter_in_stock()))
+        results["list_rented"] = timed(lambda: sum(1 for _ in store.iter_rented()))
+        results["list_books"] = timed(lambda: sum(1 for _ in store.iter_books()))
+
+        # Getting new book ids one at a time, like add_book does
+        results["allocate_ids"] = timed(lambda: [store.allocate_ids(1) for _ in range(200)], 200)
+
+        # Stop the scoring processes before the folder is deleted
+        if computer.scoring_engine.pool:
+            computer.scoring_engine.pool.shutdown()
+        os.chdir(ROOT)
+    return results
+
+def load_previous(path):
+    # The results of an older run, by (benchmark, backend, books)
+    previous = {}
+    with open(path, "r") as f:
+        for line in f:
+            if line.strip():
+                result = json.loads(line)
+                previous[(result["benchmark"], result["backend"], result["books"])] = result
+    return previous
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Library Computer benchmarks")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 100000], help="the catalog sizes (like 1000 100000 1000000)")
+    parser.add_argument("--backend", choices=["json", "sqlite"], default="json")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--searches", type=int, default=20, help="how many different searches to time (searching a big catalog is slow)")
+    parser.add_argument("--output", help="also write the results to this file")
+    parser.add_argument("--compare", help="the output file of an older run to compare with")
+    args = parser.parse_args()
+
+    previous = load_previous(args.compare) if args.compare else {}
+    output = open(args.output, "w") if args.output else None
+    run_information = {"commit": git_commit(), "python": platform.python_version(), "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+    for books in args.sizes:
+        for benchmark, timing in run_size(books, args.backend, args.seed, args.searches).items():
+            result = {"benchmark": benchmark, "backend": args.backend, "books": books, **timing, **run_information}
+
+            old = previous.get((benchmark, args.backend, books))
+            if old:
+                result["previous_us_per_op"] = old["us_per_op"]
+                result["change"] = round(timing["us_per_op"] / max(old["us_per_op"], 1e-9), 3)
+                result["regression"] = result["change"] > 1.2
+
+            line = json.dumps(result)
+            print(line, flush=True)
+            if output:
+                output.write(line + "\n")
+
+    if output:
+        output.close()
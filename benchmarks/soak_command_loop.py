@@ -0,0 +1,124 @@
+import builtins
+import contextlib
+import gc
+import inspect
+import json
+import os
+import random
+import sys
+import tempfile
+import tracemalloc
+
+# Run the soak test from anywhere, the program files are one folder up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import main
+
+# usage: python benchmarks/soak_command_loop.py [operations]
+# Runs the kiosk loop with scripted input (rent, return, view, search, list, see my loans and some typos) and prints one json line
+# every 10% of the operations with the memory the program uses and how deep the stack is. Both have to stay flat: the stack depth
+# must be the same every time and the memory at the end can only be a little more than after the first 20% of the operations
+# (when the caches and the loans are already full), otherwise it prints what grew and exits with 1
+
+# How much the memory can grow after the first 20% of the operations
+MEMORY_TOLERANCE = 1.1
+
+def scripted_input(operations, book_count, samples):
+    # The answers of a visitor to the menu and to the first question of every option, one operation after the other
+    # (the questions that are only asked sometimes, like the visitor id or the next page, are answered by answer_prompt)
+    random_generator = random.Random(1)
+    yield "visitor"
+    for operation in range(operations):
+        if operation % (operations // 10) == 0:
+            samples.append(operation)
+        book_id = str(random_generator.randint(1, book_count))
+        choice = random_generator.randint(1, 7)
+        if choice == 1:
+            yield from ("1", book_id)
+        elif choice == 2:
+            yield from ("2", book_id)
+        elif choice == 3:
+            yield from ("5", book_id)
+        elif choice == 4:
+            yield from ("4", f"book {book_id}")
+        elif choice == 5:
+            yield "3"
+        elif choice == 6:
+            yield "6"
+        else:
+            yield "rnt bok"
+
+def answer_prompt(prompt, visitor_id):
+    # The answer to a question that is only asked sometimes (rent and return only ask for the visitor id if the book can be rented
+    # or returned, and the lists only ask about the next page if there is one), or None if it is not one of those questions
+    if prompt.startswith("Please enter your visitor id"):
+        return visitor_id
+    if "next page" in prompt:
+        return "n"
+    return None
+
+def main_loop(operations):
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)
+        computer = main.LibraryComputer()
+        computer.settings["menu_delay"] = 0
+        book_count = 100
+        computer.store.mutate_many([
+            ("add_new", str(i), {"id": str(i), "name": f"Book {i}", "author": "Author", "available_count": 3, "rented_count": 0})
+            for i in range(1, book_count + 1)
+        ])
+
+        samples = []
+        answers = scripted_input(operations, book_count, samples)
+        reported = set()
+
+        random_generator = random.Random(2)
+        measurements = []
+
+        def answer(prompt=""):
+            # (a few visitors, so their rents and returns match some of the time)
+            scripted_answer = answer_prompt(prompt, f"V{random_generator.randint(1, 5)}")
+            if scripted_answer is not None:
+                return scripted_answer
+
+            # Every time we reach the next 10% of the operations, print the memory and the stack depth
+            # (always when the menu asks for the option, so the stack depth is measured at the same place every time)
+            if prompt.startswith("What function") and samples and samples[-1] not in reported:
+                reported.add(samples[-1])
+                gc.collect()
+                measurements.append({
+                    "operations": samples[-1],
+                    "traced_bytes": tracemalloc.get_traced_memory()[0],
+                    "stack_depth": len(inspect.stack(0))
+                })
+                print(json.dumps(measurements[-1]), file=sys.__stdout__)
+            try:
+                return next(answers)
+            except StopIteration:
+                raise EOFError
+
+        tracemalloc.start()
+        builtins.input = answer
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            computer.run()
+        tracemalloc.stop()
+        os.chdir(os.path.dirname(folder))
+
+    return check(measurements)
+
+def check(measurements):
+    # Returns True if the memory and the stack depth stayed flat, and prints what grew if they didnt
+    problems = []
+    stack_depths = {measurement["stack_depth"] for measurement in measurements}
+    if len(stack_depths) > 1:
+        problems.append(f"the stack depth changed: {sorted(stack_depths)}")
+    warm = measurements[min(2, len(measurements) - 1)]
+    last = measurements[-1]
+    if last["traced_bytes"] > warm["traced_bytes"] * MEMORY_TOLERANCE:
+        problems.append(f"the memory grew from {warm['traced_bytes']} bytes after {warm['operations']} operations "
+                        f"to {last['traced_bytes']} bytes after {last['operations']} operations")
+    for problem in problems:
+        print(problem, file=sys.__stdout__)
+    return not problems
+
+if __name__ == "__main__":
+    sys.exit(0 if main_loop(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000) else 1)
@@ -0,0 +1,156 @@
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+# Run the test from anywhere, the program files are one folder up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from CatalogStore import CatalogStore
+from SQLiteStore import SQLiteStore
+from ShardedStore import ShardedStore
+
+# usage: python benchmarks/stress_concurrent_kiosks.py [json|sqlite|sharded] [kiosks] [changes per kiosk]
+# Many kiosks (processes) rent, return and add books in the same catalog at the same time, with a tiny compaction size so the
+# journal is compacted again and again while the others write to it. At the end the catalog is loaded again and checked:
+# no copy was lost or made up (available_count + rented_count of every book is what it started with plus the copies that were added),
+# the rented count of every book is what the kiosks rented minus what they returned, no count is negative and every added book is there.
+# With the json and sharded stores the first kiosk also stops in the middle of a journal append every now and then (it leaves half a line
+# in the journal), the other kiosks must cut it off and go on instead of waiting for it forever.
+# Prints what it found and exits with 1 if anything is wrong (or if the kiosks dont finish in TIMEOUT seconds)
+
+BOOKS = 20
+COPIES = 10
+
+# How many seconds all the kiosks together can take before we say they got stuck
+TIMEOUT = 300
+
+def open_store(backend, folder):
+    if backend == "sqlite":
+        return SQLiteStore(os.path.join(folder, "data.db"), os.path.join(folder, "data.json"),
+                           os.path.join(folder, "data.journal"), os.path.join(folder, "data.counters"))
+    if backend == "sharded":
+        return ShardedStore(os.path.join(folder, "shards"), 4, os.path.join(folder, "data.json"),
+                            os.path.join(folder, "data.journal"), os.path.join(folder, "data.counters"), compact_size=2000)
+    return CatalogStore(os.path.join(folder, "data.json"), os.path.join(folder, "data.journal"), compact_size=2000,
+                        meta_path=os.path.join(folder, "data.meta.json"), counters_path=os.path.join(folder, "data.counters"))
+
+def wait_for_compaction(store):
+    # The json store compacts in a thread, wait for it so the process doesnt stop in the middle of a compaction
+    shards = store.shards if isinstance(store, ShardedStore) else [store]
+    for shard in shards:
+        if getattr(shard, "compaction_thread", None):
+            shard.compaction_thread.join()
+
+def tear_journals(store):
+    # Append half of a record to the journal while the lock file is locked and never finish it, like a kiosk that stopped
+    # in the middle of an append (the lock of a kiosk that stops is released by the system)
+    for shard in store.shards if isinstance(store, ShardedStore) else [store]:
+        with shard.file_lock(), open(shard.journal_path, "ab") as f:
+            f.write(b'{"op": "add_new", "id": "torn", "book": {"name": "Tor')
+
+def kiosk(backend, folder, number, changes):
+    # One kiosk, it returns how many copies of every book it rented (minus the returns) and added, and the ids of the books it added
+    random.seed(number)
+    store = open_store(backend, folder)
+    rented = {str(i): 0 for i in range(1, BOOKS + 1)}
+    added = {str(i): 0 for i in range(1, BOOKS + 1)}
+    new_books = []
+    for i in range(changes):
+        book_id = str(random.randint(1, BOOKS))
+        action = random.choice(["rent", "rent", "return", "return", "add_old"])
+        if store.mutate(action, book_id):
+            if action == "rent":
+                rented[book_id] += 1
+            elif action == "return":
+                rented[book_id] -= 1
+            else:
+                added[book_id] += 1
+
+        # Every now and then add a new book with a name long enough to grow the journal
+        if i % 10 == 0:
+            new_id = f"k{number}-{i}"
+            if store.mutate("add_new", new_id, new_book(new_id, 1)):
+                new_books.append(new_id)
+
+        # The first kiosk stops in the middle of an append every 50 changes (the json and sharded stores have a journal)
+        if number == 0 and backend != "sqlite" and i % 50 == 25:
+            tear_journals(store)
+    wait_for_compaction(store)
+    return rented, added, new_books
+
+def new_book(book_id, copies):
+    return {
+        "name": f"Stress book {book_id} " + "x" * 40,
+        "id": book_id,
+        "available_count": copies,
+        "rented_count": 0,
+        "release_date": "01/01/2000",
+        "description": "",
+        "author": "Stress",
+        "search_query": f"stressbook{book_id}"
+    }
+
+def run(backend, kiosks, changes):
+    with tempfile.TemporaryDirectory() as folder:
+
+        # Start with BOOKS books of COPIES copies each (in data.json, the sqlite and sharded stores copy it when they start)
+        store = CatalogStore(os.path.join(folder, "data.json"), os.path.join(folder, "data.journal"),
+                             meta_path=os.path.join(folder, "data.meta.json"), counters_path=os.path.join(folder, "data.counters"))
+        store.mutate_many([("add_new", str(i), new_book(str(i), COPIES)) for i in range(1, BOOKS + 1)])
+        wait_for_compaction(store)
+        del store
+        store = open_store(backend, folder)
+
+        # The kiosks start with half a line at the end of the journal too (like after a kiosk stopped while nobody else was running)
+        if backend != "sqlite":
+            tear_journals(store)
+
+        start_time = time.perf_counter()
+        with multiprocessing.Pool(kiosks) as pool:
+            try:
+                results = pool.starmap_async(kiosk, [(backend, folder, number, changes) for number in range(kiosks)]).get(TIMEOUT)
+            except multiprocessing.TimeoutError:
+                print(json.dumps({"backend": backend, "kiosks": kiosks, "changes": kiosks * changes, "problems": 1}))
+                print(f"the kiosks got stuck, they didnt finish in {time.perf_counter() - start_time:.0f} seconds")
+                return False
+
+        # Load the catalog again (like a kiosk that just started) and check every book
+        books = {book["id"]: book for book in open_store(backend, folder).iter_books()}
+        problems = []
+        for i in range(1, BOOKS + 1):
+            book_id = str(i)
+            book = books.get(book_id)
+            rented = sum(result[0][book_id] for result in results)
+            added = sum(result[1][book_id] for result in results)
+            if book is None:
+                problems.append(f"book {book_id} is missing")
+                continue
+            if book["available_count"] + book["rented_count"] != COPIES + added:
+                problems.append(f"book {book_id} has {book['available_count']} + {book['rented_count']} copies, expected {COPIES + added}")
+            if book["rented_count"] != rented:
+                problems.append(f"book {book_id} has {book['rented_count']} rented copies, the kiosks rented {rented}")
+            if book["available_count"] < 0 or book["rented_count"] < 0:
+                problems.append(f"book {book_id} has a negative count")
+        if "torn" in books:
+            problems.append("the half written book of the journal was loaded")
+        new_books = [book_id for result in results for book_id in result[2]]
+        for book_id in new_books:
+            book = books.get(book_id)
+            if book is None:
+                problems.append(f"added book {book_id} is missing")
+            elif book["available_count"] + book["rented_count"] != 1:
+                problems.append(f"added book {book_id} has {book['available_count']} + {book['rented_count']} copies, expected 1")
+
+    print(json.dumps({"backend": backend, "kiosks": kiosks, "changes": kiosks * changes, "books": len(books), "added_books": len(new_books), "problems": len(problems)}))
+    for problem in problems[:20]:
+        print(problem)
+    return not problems
+
+if __name__ == "__main__":
+    backend = sys.argv[1] if len(sys.argv) > 1 else "json"
+    kiosks = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    changes = int(sys.argv[3]) if len(sys.argv) > 3 else 300
+    sys.exit(0 if run(backend, kiosks, changes) else 1)
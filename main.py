@@ -1,62 +1,227 @@
-from fuzzywuzzy import fuzz
 from Librarian import Librarian
 from Visitor import Visitor
+from CatalogStore import CatalogStore
+from SQLiteStore import SQLiteStore
+from ShardedStore import ShardedStore, rebalance
+from SearchIndex import SearchIndex
+from BrowseIndex import BrowseIndex
+from ScoringEngine import ScoringEngine
+from LibraryServer import LibraryServer
+from LibraryClient import LibraryClient, LoanClient
+from LoanLedger import LoanLedger
+from BulkImport import BulkImporter
+from WriteScheduler import WriteScheduler
+from LRUCache import LRUCache
+from BatchCommands import BatchRunner
+from Metrics import METRICS
+import argparse
+import asyncio
+import itertools
 import os
-from time import sleep as wait
+import sys
+from time import sleep as wait, perf_counter
 
 # Class for the library computer
 class LibraryComputer:
 
     # INIT method that is called when the class is instantiated (created)
-    def __init__(self):
+    def __init__(self, client_address=None, settings=None):
+
+        # If we got the address of a library server we run as a client of it (the server keeps the catalog, we only show the menus)
+        self.client_address = client_address
+
+        # The settings of the library computer
+        self.settings = {
+            # Where the book data is stored: "json" (data.json with a journal of changes), "sqlite" (an sqlite database,
+            # the first time it is used it copies all the books from data.json) or "sharded" (the books are split into shard_count
+            # json stores in the shards folder by the hash of their id, the first time it is used it splits data.json into them,
+            # after that the number of shards is changed with --rebalance)
+            "storage_backend": "json",
+            "sqlite_path": "./data.db",
+            "shard_count": 4,
+
+            # When the journal of book changes gets bigger than this many bytes it is folded back into data.json
+            "journal_compact_size": 256 * 1024,
+
+            # The snapshot file of the json store keeps the parsed catalog and the search index, so starting again doesnt have to
+            # parse data.json and build the search index (it is only used while data.json is the same), None turns it off
+            "snapshot_path": "./data.snapshot",
+
+            # How many processes score fuzzy matches at the same time (None means one for every core), how many items
+            # every process scores at a time, and below how many items we dont bother starting the processes
+            "scoring_workers": None,
+            "scoring_chunk_size": 2000,
+            "scoring_min_parallel_items": 5000,
+
+            # How many search results are shown on every page, and how many books on every page of the book lists
+            "search_page_size": 10,
+            "list_page_size": 20,
+
+            # How many new book ids a kiosk reserves at a time, every reservation writes and fsyncs the id file so reserving them
+            # one at a time makes adding books slow (the ids a kiosk reserved and didnt use before it stopped are skipped)
+            "id_block_size": 64,
+
+            # How many books a bulk import saves together with one write, and how many changes a batch of commands saves together
+            "import_batch_size": 1000,
+            "batch_commit_size": 1000,
+
+            # Group commit: a change waits up to this many seconds for other changes (or until there are this many changes)
+            # and they are all saved with one write. With a window of 0 only the changes that arrive while the previous group
+            # is being saved are grouped, and a max of 1 saves every change on its own
+            "group_commit_window": 0,
+            "group_commit_max_changes": 64,
+
+            # How many seconds to wait before showing the options again (just for cosmetics), 0 turns it off
+            "menu_delay": 2,
+
+            # How many different searches (the best matches of every search) and fuzzy menu matches are kept in the caches,
+            # and how many pages of results a search ranks at a time (going past them ranks the search again with twice as many)
+            "search_cache_size": 256,
+            "search_rank_pages": 5,
+            "match_cache_size": 256,
+
+            # The loan ledger (who borrowed which book): the journal of the open loans, the history file the returned loans are moved to
+            # when the journal gets bigger than loans_compact_size bytes, and how many days a visitor can keep a book
+            "loans_path": "./loans.journal",
+            "loans_history_path": "./loans.history.jsonl",
+            "loans_compact_size": 1024 * 1024,
+            "loan_days": 14,
+
+            # The file the metrics (how long every option took, how much was read and written) are saved to when the program
+            # ends, in the prometheus text format (or as json if the file name ends with .json), None doesnt save them
+            "metrics_path": None,
+
+            # The address the library server listens on ("host:port" or "unix:/path/to/socket"), and how many lists the kiosks go over
+            # a page at a time it keeps open and for how many seconds after their last page (kiosks close their lists when they stop paging)
+            "server_address": "127.0.0.1:7878",
+            "list_cursor_cache_size": 64,
+            "list_cursor_seconds": 300
+        }
+
+        # Settings given to the constructor (like from the benchmarks) replace the default ones
+        self.settings.update(settings or {})
+
+        # Create the catalog store, it is shared by the librarian and the visitor and they only talk to it (and not to the files)
+        self.store = self.create_store()
+
+        # Save the changes that arrive at the same time (like from many kiosks connected to the library server) together
+        if not self.client_address and self.settings["group_commit_max_changes"] > 1:
+            self.store.write_scheduler = WriteScheduler(self.store, self.settings["group_commit_window"], self.settings["group_commit_max_changes"])
+
+        # Create the loan ledger, it is shared by the librarian and the visitor (a client asks the library server for the loans)
+        if self.client_address:
+            self.loans = LoanClient(self.store)
+        else:
+            self.loans = LoanLedger(self.settings["loans_path"], self.settings["loans_history_path"], self.settings["loans_compact_size"])
+
+        # Create the search index, it keeps a trigram index of the book search queries up to date with the catalog store
+        # (a client doesnt need one, the server searches for it)
+        self.search_index = None if self.client_address else SearchIndex(self.store)
+
+        # Create the browse index, it keeps the books of every author and a sorted list of the release dates up to date with the catalog store
+        # (a client doesnt need one either)
+        self.browse_index = None if self.client_address else BrowseIndex(self.store)
+
+        # If the catalog wasnt loaded from the snapshot file (or it changed since), save a new snapshot for the next start
+        self.save_snapshot()
+
+        # Create the scoring engine, it scores big lists of fuzzy matches on all the cores of the computer
+        self.scoring_engine = ScoringEngine(
+            self.settings["scoring_workers"],
+            self.settings["scoring_chunk_size"],
+            self.settings["scoring_min_parallel_items"]
+        )
+
+        # The caches of the search results (the key has the catalog version so a change to the catalog is never missed)
+        # and of the fuzzy matches of the menu options and roles (those lists never change)
+        self.search_cache = LRUCache(self.settings["search_cache_size"])
+        self.match_cache = LRUCache(self.settings["match_cache_size"])
 
         # Initiate the librarian and visitor classes, as we pass self to the constructor which means those classes have
         # access to the functions and variables of this class
         self.visitor = Visitor(self)
         self.librarian = Librarian(self)
 
-        # Initiate the roles and variables
+        # Initiate the roles and variables (input_wait is how many seconds ask() waited for the user during the current option)
         self.chosen_role = None
+        self.input_wait = 0
         self.roles = ["visitor", "librarian"]
         self.role_options = {
             "librarian": [
                 "add book",
                 "see rented books",
                 "change password",
-                "see book stock"
+                "see book stock",
+                "import books",
+                "see metrics",
+                "see overdue loans",
+                "see book loans"
             ],
             "visitor": [
                 "rent book",
                 "return book",
                 "see book list",
                 "search book",
-                "view book"
+                "view book",
+                "see my loans",
+                "browse by author",
+                "browse by release date"
             ]
         }
 
-        print("Welcome to the Library Computer.")
-        print("----------------------------------------")
+    def create_store(self):
+
+        # A client sends everything to the library server
+        if self.client_address:
+            return LibraryClient(self.client_address)
+
+        # The sqlite store keeps the books in a database with indexes for the stock and rented lists
+        if self.settings["storage_backend"] == "sqlite":
+            return SQLiteStore(self.settings["sqlite_path"], "./data.json", "./data.journal", "./data.counters")
+
+        # The sharded store keeps every shard in its own json store, the changes of different shards dont wait for each other
+        if self.settings["storage_backend"] == "sharded":
+            return ShardedStore(
+                "./shards", self.settings["shard_count"], "./data.json", "./data.journal", "./data.counters",
+                self.settings["journal_compact_size"], self.settings["id_block_size"]
+            )
+
+        # The json store keeps the book data in memory so the data.json file is only read again when it changes,
+        # new books are appended to the journal and the available and rented counts are changed in place in the counter file
+        return CatalogStore("./data.json", "./data.journal", self.settings["journal_compact_size"], "./data.meta.json", self.settings["id_block_size"], "./data.counters", self.settings["snapshot_path"])
+
+    def print_paged(self, lines):
+        # Print the lines (it can be a generator) a page at a time, after every full page ask the user if they want to see the next one
+        page_size = self.settings["list_page_size"]
+        lines = iter(lines)
+        while True:
+            page = list(itertools.islice(lines, page_size))
+            for line in page:
+                print(line)
+
+            # Stop if this was the last page or the user doesnt want to see more
+            if len(page) < page_size:
+                return
+            if self.ask("See the next page? (y/n): ").lower() != "y":
+                return
 
     def fuzzy_match_to_list(self, string, lst):
 
         # Setup function variables
-        matches = []
         fuzzy_threshold = 80
 
-        # Loop over every item in the given list
-        for item in lst:
-
-            # Get the score of the match between the current item of the list and the given string,
-            # if the score is greater than the threshold add to the match list
-            ratio_score = fuzz.ratio(string, item)
-            if ratio_score > fuzzy_threshold:
-                matches.append({
-                    "item": item,
-                    "score": ratio_score
-                })
-        
-        # Sort the matches by score
-        return sorted(matches, key=lambda k: k["score"], reverse=True)
+        # If we already matched this string to this list, return the matches we already have
+        cache_key = (string, tuple(lst))
+        matches = self.match_cache.get(cache_key)
+        if matches is not None:
+            return matches
+
+        # Get the score of the match between every item of the list and the given string, the scoring engine
+        # only returns the items with a score greater than the threshold, sorted by the score
+        matches, total = self.scoring_engine.score(string, [(item, item) for item in lst], "ratio", fuzzy_threshold)
+        matches = [{"item": item, "score": score} for item, score in matches]
+        self.match_cache.put(cache_key, matches)
+        return matches
 
     def verify_role(self, role):
 
@@ -74,7 +239,7 @@ class LibraryComputer:
         # If the length of the option is of length of one then that means the option is an ID and not an option name
         # And because the option id is just the index (but +1) we just use it as the index-1
         # ^^^ Thats just to convert an option id to an option name
-        if len(option) == 1:
+        if len(option) == 1 and option.isdigit() and 1 <= int(option) <= len(self.role_options[self.chosen_role]):
             option = self.role_options[self.chosen_role][int(option)-1]
         
         # If the option name is inside the possible options for a given role, verify it, and return True. (with the option name incase the user entered an ID)
@@ -89,9 +254,37 @@ class LibraryComputer:
         }
 
 
+    def run(self):
+        # The main loop of the kiosk: until a role is chosen ask for the role, then show the options of the role, do the chosen one and
+        # come back here. Every screen returns to this loop when it is done (instead of calling the next screen itself) so the program
+        # doesnt get deeper and deeper the longer it runs
+        try:
+            while True:
+                if self.chosen_role is None:
+                    self.ask_role()
+                else:
+                    self.role_funcs()
+        except EOFError:
+            # There is no more input (like when the input comes from a file, or the user pressed ctrl+d), so we stop
+            print("\nGoodbye!")
+        finally:
+            self.save_snapshot()
+            self.dump_metrics()
+
+    def save_snapshot(self):
+        # Save the catalog and the search index for the next start (the client doesnt have them, the server does)
+        if not self.client_address:
+            self.store.save_snapshot(self.search_index)
+
+    def dump_metrics(self):
+        # Save the metrics to the metrics file (if there is one)
+        if self.settings["metrics_path"]:
+            METRICS.dump(self.settings["metrics_path"])
+
     def role_funcs(self):
         # Add some delay just for cosmetics
-        wait(2)
+        if self.settings["menu_delay"]:
+            wait(self.settings["menu_delay"])
 
         print("Here are the options you can do:")
 
@@ -100,58 +293,127 @@ class LibraryComputer:
             print(f"\t{index+1}. {func_option} (id: {index+1})".title())
         
         # Get the chosen option from the user and verify it.
-        option = input("What function do you choose? (id/name): ")
+        option = self.ask("What function do you choose? (id/name): ")
         option_verified = self.verify_option(option)
         
-        # If the option is verfied then just check the role and if its a visitor call the do_option function for the visitor, same for the librarian
+        # If the option is verfied then run it for the chosen role
         if option_verified["verified"]:
-            if self.chosen_role == "visitor":
-                self.visitor.do_option(option_verified["option"])
-            elif self.chosen_role == "librarian":
-                self.librarian.do_option(option_verified["option"])
+            self.run_option(option_verified["option"])
         else:
-            # Incase there was no match for the option, print a message (with the most similar option if it exists) and ask for the option again
+            # Incase there was no match for the option, print a message (with the most similar option if it exists), the loop asks for the option again
             print(f"There was no match for {option_verified['option']}, {('did you mean ' + option_verified['option_meant'][0]['item'] + '? ') if len(option_verified['option_meant'])else ''}please try again.")
             print("---------------------\n")
-            self.role_funcs()
+
+    def run_option(self, option):
+        # Check the role and if its a visitor call the do_option function for the visitor, same for the librarian.
+        # Every option is timed, but the options ask the user questions and the time the user takes to answer them is not work
+        # of the library computer, so ask() adds up how long it waited for the user while the option runs. That time is
+        # recorded as input_wait_seconds and option_seconds only has the rest
+        labels = {"role": self.chosen_role, "option": option}
+        self.input_wait = 0
+        start_time = perf_counter()
+        try:
+            if self.chosen_role == "visitor":
+                self.visitor.do_option(option)
+            elif self.chosen_role == "librarian":
+                self.librarian.do_option(option)
+        finally:
+            METRICS.observe("option_seconds", perf_counter() - start_time - self.input_wait, labels)
+            METRICS.observe("input_wait_seconds", self.input_wait, labels)
+
+    def ask(self, prompt=""):
+        # Ask the user a question and return the answer, every question of the menus and the roles goes through here
+        # so the time we wait for the user is added to input_wait (and not counted as the work of the option)
+        input_start_time = perf_counter()
+        try:
+            return input(prompt)
+        finally:
+            self.input_wait += perf_counter() - input_start_time
 
     def ask_role(self):
 
         # Asks the user to choose a role
-        role = input("Please choose your role [librarian/visitor]: ")
+        role = self.ask("Please choose your role [librarian/visitor]: ")
 
         # Verify the role
         role_verified = self.verify_role(role)
 
         # If it is verified and the role is librarian
         if role_verified["verified"]:
-            self.chosen_role = role
-            if self.chosen_role == "librarian":
+            role = role.lower()
+            if role == "librarian":
 
                 # Check if the password hash file exists (which means a password has been chosen before)
                 if os.path.exists("./password_hash.hash"):
-                    password = input("Please enter your password: ")
+                    password = self.ask("Please enter your password: ")
 
                     # Check the password with the function in the Librarian class,
-                    # if its incorrect just ask for the roles again after saying its incorrect
+                    # if its incorrect say its incorrect and return without a role (the loop asks for the role again)
                     if not self.librarian.check_password(password):
                         print("Wrong password!")
                         print("---------------")
-                        self.ask_role()
-            
-            # Greet the user and show them their options according to the chosen role
+                        return
+
+            # Greet the user, from now on the loop shows them their options according to the chosen role
+            self.chosen_role = role
             print(f"Welcome, {self.chosen_role}!")
-            self.role_funcs()
         else:
 
-            # If the user entered an unknown role just print a message (with the most similar role if it exists) and ask for the role again
+            # If the user entered an unknown role just print a message (with the most similar role if it exists), the loop asks for the role again
             print(f"There was no match for {role}, {('did you mean ' + role_verified['option_meant'][0]['item'] + '? ') if len(role_verified['option_meant'])else ''}please try again.")
             print("---------------------\n")
-            self.ask_role()
 
 
 # This will run only if this python file runs directly (not as a module or imported from another file)
 if __name__ == "__main__":
-    # Create the computer object and ask for the role
-    computer = LibraryComputer()
-    computer.ask_role()
\ No newline at end of file
+
+    # The library computer can run on its own (standalone), as a server that keeps the catalog for many kiosks, or as a client of such a server
+    parser = argparse.ArgumentParser(description="The Library Computer")
+    parser.add_argument("--serve", nargs="?", const="", metavar="ADDRESS", help="run the library server (host:port or unix:/path)")
+    parser.add_argument("--connect", metavar="ADDRESS", help="run as a client of the library server at this address")
+    parser.add_argument("--import", dest="import_path", metavar="FILE", help="import the books of a csv or jsonl file and exit")
+    parser.add_argument("--batch", nargs="?", const="-", metavar="FILE", help="run the commands of a file (or of stdin) and print the results as json lines")
+    parser.add_argument("--rebalance", type=int, metavar="N", help="split the catalog into N shards (or change the number of shards) and exit, stop the kiosks first")
+    parser.add_argument("--metrics", metavar="FILE", help="save the metrics to this file when the program ends (prometheus text, or json for a .json file)")
+    args = parser.parse_args()
+    settings = {"metrics_path": args.metrics} if args.metrics else None
+
+    if args.rebalance is not None and args.rebalance < 1:
+        parser.error(f"--rebalance needs at least 1 shard, not {args.rebalance}")
+
+    if args.rebalance is not None:
+        # Write all the books again into the new number of shards (this doesnt need the library computer, only the files)
+        count = rebalance("./shards", args.rebalance)
+        print(f"Wrote {count} books into {args.rebalance} shards")
+    elif args.batch is not None:
+        # Create the computer object and run the commands (from stdin if there is no file)
+        computer = LibraryComputer(args.connect, settings)
+        runner = BatchRunner(computer, computer.settings["batch_commit_size"])
+        if args.batch == "-":
+            runner.run(sys.stdin)
+        else:
+            with open(args.batch, "r", encoding="utf-8") as f:
+                runner.run(f)
+        computer.save_snapshot()
+        computer.dump_metrics()
+    elif args.import_path:
+        # Create the computer object and import the books of the file in batches
+        computer = LibraryComputer(args.connect, settings)
+        BulkImporter(computer, computer.settings["import_batch_size"]).import_file(args.import_path)
+        computer.save_snapshot()
+        computer.dump_metrics()
+    elif args.serve is not None:
+        # Create the computer object and serve its catalog to the kiosks
+        computer = LibraryComputer(settings=settings)
+        server = LibraryServer(computer, args.serve or computer.settings["server_address"])
+        try:
+            asyncio.run(server.serve_forever())
+        finally:
+            computer.save_snapshot()
+            computer.dump_metrics()
+    else:
+        # Create the computer object and ask for the role
+        computer = LibraryComputer(args.connect, settings)
+        print("Welcome to the Library Computer.")
+        print("----------------------------------------")
+        computer.run()
\ No newline at end of file